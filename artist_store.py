@@ -0,0 +1,218 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from http_client import background_requests
+from response_cache import LruCache
+
+ARTIST_PROFILE_DB = os.getenv("ARTIST_PROFILE_DB", "artist_profiles.db")
+# past this a profile is still shown, but a view also refreshes it in the background
+ARTIST_PROFILE_TTL = int(os.getenv("ARTIST_PROFILE_TTL", 6 * 3600))
+# how often one user's followed and recently played artists are checked for profiles to warm
+ARTIST_WARM_INTERVAL = int(os.getenv("ARTIST_WARM_INTERVAL", 1800))
+ARTIST_WARM_USERS = int(os.getenv("ARTIST_WARM_USERS", 1000))
+# the several-artists endpoint takes at most 50 ids per call
+ARTIST_REFRESH_BATCH = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artist_profiles (
+    artist_id TEXT PRIMARY KEY,
+    name_key TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    refreshed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artist_profiles_name_key ON artist_profiles (name_key);
+"""
+
+
+def name_key(name):
+    return (name or "").strip().casefold()
+
+
+class ArtistProfileStore:
+    # web api fields, top tracks and the scraped artist page of every artist we have shown, under one refresh time
+    # artists are the same for every user, so one profile serves everyone
+    def __init__(self, path=ARTIST_PROFILE_DB, ttl=ARTIST_PROFILE_TTL):
+        self.path = path
+        self.ttl = ttl
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def row_to_profile(self, row):
+        if row is None:
+            return None
+        profile = json.loads(row[0])
+        profile["refreshed_at"] = row[1]
+        return profile
+
+    def get(self, artist_id):
+        with self.connect() as conn:
+            row = conn.execute("SELECT profile, refreshed_at FROM artist_profiles WHERE artist_id = ?", (artist_id,)).fetchone()
+        return self.row_to_profile(row)
+
+    def find(self, name):
+        # what the search box typed, only an exact (case insensitive) name is trusted, anything else still goes to search
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT profile, refreshed_at FROM artist_profiles WHERE name_key = ? ORDER BY refreshed_at DESC LIMIT 1",
+                (name_key(name),)
+            ).fetchone()
+        return self.row_to_profile(row)
+
+    def known_ids(self, artist_ids):
+        with self.connect() as conn:
+            rows = conn.execute(
+                f"SELECT artist_id FROM artist_profiles WHERE artist_id IN ({','.join('?' * len(artist_ids))})",
+                list(artist_ids)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def put_many(self, profiles):
+        now = time.time()
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO artist_profiles (artist_id, name_key, profile, refreshed_at) VALUES (?, ?, ?, ?)",
+                [(profile["id"], name_key(profile["name"]), json.dumps(profile), now) for profile in profiles]
+            )
+
+    def is_stale(self, profile):
+        return time.time() - profile["refreshed_at"] >= self.ttl
+
+    def stale_ids(self, artist_ids):
+        # the ids we have no profile for, or only an old one
+        artist_ids = list(dict.fromkeys(artist_ids))
+        fresh = set()
+        with self.connect() as conn:
+            for start in range(0, len(artist_ids), 500):
+                batch = artist_ids[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT artist_id FROM artist_profiles WHERE refreshed_at > ? AND artist_id IN ({','.join('?' * len(batch))})",
+                    (time.time() - self.ttl, *batch)
+                ).fetchall()
+                fresh.update(row[0] for row in rows)
+        return [artist_id for artist_id in artist_ids if artist_id not in fresh]
+
+    def stats(self):
+        with self.connect() as conn:
+            profiles, stale = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(refreshed_at <= ?), 0) FROM artist_profiles",
+                (time.time() - self.ttl,)
+            ).fetchone()
+        return {"profiles": profiles, "stale": stale, "ttl": self.ttl}
+
+
+class ArtistProfileWarmer:
+    # a single background thread that fills the profile store, pages only ever queue work for it
+    # loader(spotify_api, artist_ids, fresh) returns {artist id: profile}, warm_ids(spotify_api) the artists worth warming for a user
+    # fresh is set for artists that already have a profile, a refresh has to go past the caches or it would store the same old data
+    # spotify only answers with a user's token, so each job carries the SpotifyApi of the request that queued it
+    def __init__(self, store, loader, warm_ids, warm_interval=ARTIST_WARM_INTERVAL):
+        self.store = store
+        self.loader = loader
+        self.warm_ids = warm_ids
+        self.warm_interval = warm_interval
+        self.jobs = queue.Queue()
+        # artist ids waiting for or in the middle of a refresh, so the same artist is not queued twice
+        self.queued = set()
+        # users warmed within warm_interval, bounded like the other per user state
+        self.warmed_at = LruCache(ARTIST_WARM_USERS, warm_interval)
+        self.counters = {"warm_jobs": 0, "refreshed": 0, "failed": 0}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name="artist-profile-warmer", daemon=True)
+            self.thread.start()
+
+    def claim(self, artist_ids):
+        with self.lock:
+            claimed = [artist_id for artist_id in dict.fromkeys(artist_ids) if artist_id and artist_id not in self.queued]
+            self.queued.update(claimed)
+        return claimed
+
+    def refresh_in_background(self, spotify_api, artist_ids):
+        artist_ids = self.claim(artist_ids)
+        if artist_ids:
+            self.start()
+            self.jobs.put((spotify_api, None, artist_ids))
+
+    def warm(self, spotify_api):
+        # at most once per warm_interval per user, the ids are gathered on the worker so the page does not wait for them
+        user_key = spotify_api.get_user_key()
+        with self.lock:
+            if self.warmed_at.get(user_key):
+                return
+            self.warmed_at.set(user_key, True)
+        self.start()
+        self.jobs.put((spotify_api, user_key, None))
+
+    def load(self, spotify_api, batch, fresh):
+        try:
+            profiles = self.loader(spotify_api, batch, fresh)
+        except Exception as e:
+            print(f"Error refreshing artist profiles: {e}")
+            profiles = {}
+
+        if profiles:
+            self.store.put_many(list(profiles.values()))
+        with self.lock:
+            self.counters["refreshed"] += len(profiles)
+            self.counters["failed"] += len(batch) - len(profiles)
+
+    def refresh(self, spotify_api, artist_ids):
+        try:
+            for start in range(0, len(artist_ids), ARTIST_REFRESH_BATCH):
+                batch = artist_ids[start:start + ARTIST_REFRESH_BATCH]
+                known = self.store.known_ids(batch)
+                new_ids = [artist_id for artist_id in batch if artist_id not in known]
+                if new_ids:
+                    self.load(spotify_api, new_ids, fresh=False)
+                if known:
+                    self.load(spotify_api, [artist_id for artist_id in batch if artist_id in known], fresh=True)
+        finally:
+            with self.lock:
+                self.queued.difference_update(artist_ids)
+
+    def run(self):
+        # this thread only ever does background work, its calls wait behind the ones pages make
+        background_requests.set(True)
+        while True:
+            spotify_api, user_key, artist_ids = self.jobs.get()
+            try:
+                if artist_ids is None:
+                    with self.lock:
+                        self.counters["warm_jobs"] += 1
+                    artist_ids = self.claim(self.store.stale_ids(self.warm_ids(spotify_api)))
+                self.refresh(spotify_api, artist_ids)
+            except Exception as e:
+                print(f"Error warming artist profiles for {user_key}: {e}")
+            finally:
+                self.jobs.task_done()
+
+    def wait_idle(self):
+        # blocks until every queued job is done, for benchmarks
+        self.jobs.join()
+
+    def cancel_pending(self):
+        # drops the jobs that have not started yet, the one running finishes on its own
+        while True:
+            try:
+                _, _, artist_ids = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                self.queued.difference_update(artist_ids or [])
+            self.jobs.task_done()
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "queued": len(self.queued), "pending_jobs": self.jobs.qsize()}
@@ -0,0 +1,242 @@
+"""Builds fingerprinted, precompressed copies of static/ into static/dist for far-future caching.
+
+Every file gets its content hash in its name, images get a WebP (and AVIF when Pillow
+supports it) variant at the width they are shown at, and css gets its url(img/...) references
+rewritten to the hashed names plus .gz and .br (when brotli is installed) copies next to it. Templates link assets through
+asset_url, which reads the manifest written here.
+
+    python assets.py
+
+Pillow and brotli are in requirements.txt. Without them the build still runs, but images are only
+fingerprinted and css only gzipped.
+"""
+import argparse
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import re
+import shutil
+
+# the app imports this module for AssetManifest, Pillow and brotli are only imported once a build needs them
+HAS_PILLOW = importlib.util.find_spec("PIL") is not None
+HAS_BROTLI = importlib.util.find_spec("brotli") is not None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, "static")
+ASSET_DIR = os.getenv("ASSET_DIR", os.path.join(STATIC_DIR, "dist"))
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+# nothing on the site is shown wider than this, bigger originals are scaled down when re-encoded
+# images are only used as css backgrounds and image-set cannot choose by width, so this is the one variant width
+MAX_IMAGE_WIDTH = 1920
+COMPRESS_EXTENSIONS = {".css", ".js", ".svg", ".json"}
+
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+# most compact first
+FORMAT_PREFERENCE = ("avif", "webp")
+MIME_TYPES = {"webp": "image/webp", "avif": "image/avif", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".gif": "image/gif"}
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def hashed_name(logical, data, suffix=""):
+    base, ext = os.path.splitext(logical)
+    return f"{base}{suffix}.{content_hash(data)}{ext}"
+
+
+def write(out_dir, name, data):
+    path = os.path.join(out_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def encode_image(image, fmt, **options):
+    buffer = io.BytesIO()
+    if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif image.mode == "P":
+        image = image.convert("RGBA")
+    image.save(buffer, fmt, **options)
+    return buffer.getvalue()
+
+
+def scaled(image, width):
+    from PIL import Image
+    if image.width <= width:
+        return image
+    return image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+
+
+def variant_formats():
+    from PIL import features
+    formats = ["webp"]
+    try:
+        if features.check("avif"):
+            formats.append("avif")
+    except (ValueError, KeyError):
+        pass
+    return formats
+
+
+def build_image(logical, data, out_dir):
+    # returns (hashed name of the image in its own format, its webp/avif variants)
+    ext = os.path.splitext(logical)[1].lower()
+    if not HAS_PILLOW:
+        name = hashed_name(logical, data)
+        write(out_dir, name, data)
+        return name, []
+
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+
+        # the original format stays the fallback, re-encoded only when that actually makes it smaller
+        original = data
+        if ext in (".jpg", ".jpeg"):
+            original = min(data, encode_image(scaled(image, MAX_IMAGE_WIDTH), "JPEG", quality=85, optimize=True, progressive=True), key=len)
+        elif ext == ".png":
+            original = min(data, encode_image(scaled(image, MAX_IMAGE_WIDTH), "PNG", optimize=True), key=len)
+        name = hashed_name(logical, original)
+        write(out_dir, name, original)
+
+        variants = []
+        width = min(image.width, MAX_IMAGE_WIDTH)
+        for fmt in variant_formats():
+            encoded = encode_image(scaled(image, width), fmt.upper(), quality=80 if fmt == "webp" else 60)
+            variant = hashed_name(os.path.splitext(logical)[0] + f".{fmt}", encoded, f"-{width}w")
+            write(out_dir, variant, encoded)
+            variants.append({"path": variant, "format": fmt, "width": width, "size": len(encoded)})
+        return name, variants
+
+
+def css_target(css_dir, reference):
+    return os.path.normpath(os.path.join(css_dir, reference)).replace(os.sep, "/")
+
+
+def css_relative(css_dir, path):
+    return os.path.relpath(path, css_dir or ".").replace(os.sep, "/")
+
+
+def rewrite_css(css, css_logical, assets, variants):
+    # points url(img/...) at the hashed files, and where a webp copy exists adds an image-set line after the
+    # original one, browsers that do not understand image-set keep using the line above it
+    css_dir = os.path.dirname(css_logical)
+
+    def hashed_url(match):
+        target = css_target(css_dir, match.group(2))
+        if target not in assets:
+            return match.group(0)
+        return f'url("{css_relative(css_dir, assets[target])}")'
+
+    def image_set(match):
+        target = css_target(css_dir, match.group(2))
+        if not variants.get(target):
+            return hashed_url(match)
+
+        options = [
+            f'url("{css_relative(css_dir, variant["path"])}") type("{MIME_TYPES[variant["format"]]}")'
+            for variant in sorted(variants[target], key=lambda variant: FORMAT_PREFERENCE.index(variant["format"]))
+        ]
+        options.append(f'{hashed_url(match)} type("{MIME_TYPES.get(os.path.splitext(target)[1].lower(), "image/png")}")')
+        return f"image-set({', '.join(options)})"
+
+    lines = []
+    for line in css.splitlines():
+        lines.append(CSS_URL_RE.sub(hashed_url, line))
+        if any(variants.get(css_target(css_dir, match.group(2))) for match in CSS_URL_RE.finditer(line)):
+            lines.append(CSS_URL_RE.sub(image_set, line))
+    return "\n".join(lines) + "\n"
+
+
+def precompress(out_dir, name, data):
+    write(out_dir, name + ".gz", gzip.compress(data, 9, mtime=0))
+    if HAS_BROTLI:
+        import brotli
+        write(out_dir, name + ".br", brotli.compress(data, quality=11))
+
+
+def build(static_dir=STATIC_DIR, out_dir=ASSET_DIR):
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    files = []
+    for folder, dirs, names in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(folder, d)) != os.path.abspath(out_dir)]
+        for name in names:
+            files.append(os.path.relpath(os.path.join(folder, name), static_dir).replace(os.sep, "/"))
+
+    assets = {}
+    variants = {}
+    # images first, css needs their hashed names
+    for logical in sorted(files, key=lambda path: os.path.splitext(path)[1].lower() in COMPRESS_EXTENSIONS):
+        with open(os.path.join(static_dir, logical), "rb") as f:
+            data = f.read()
+        ext = os.path.splitext(logical)[1].lower()
+
+        if ext in IMAGE_EXTENSIONS:
+            assets[logical], image_variants = build_image(logical, data, out_dir)
+            if image_variants:
+                variants[logical] = image_variants
+            continue
+
+        if ext == ".css":
+            data = rewrite_css(data.decode("utf-8"), logical, assets, variants).encode("utf-8")
+        assets[logical] = hashed_name(logical, data)
+        write(out_dir, assets[logical], data)
+        if ext in COMPRESS_EXTENSIONS:
+            precompress(out_dir, assets[logical], data)
+
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump({"assets": assets, "variants": variants}, f, indent=2, sort_keys=True)
+    return assets, variants
+
+
+class AssetManifest:
+    # maps static/ paths to their fingerprinted copies, empty until `python assets.py` has been run
+    def __init__(self, directory=ASSET_DIR):
+        self.directory = directory
+        self.path = os.path.join(directory, "manifest.json")
+        self.assets = {}
+        self.variants = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            manifest = json.load(f)
+        self.assets = manifest.get("assets", {})
+        self.variants = manifest.get("variants", {})
+
+    def get(self, logical):
+        return self.assets.get(logical)
+
+    def precompressed(self, filename, accepted):
+        # best precompressed copy the client accepts, as (file to send, content-encoding)
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if encoding in accepted and os.path.exists(os.path.join(self.directory, filename + suffix)):
+                return filename + suffix, encoding
+        return filename, None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--static", default=STATIC_DIR)
+    parser.add_argument("--out", default=ASSET_DIR)
+    args = parser.parse_args()
+
+    assets, variants = build(args.static, args.out)
+    before = sum(os.path.getsize(os.path.join(args.static, logical)) for logical in assets)
+    after = sum(os.path.getsize(os.path.join(args.out, hashed)) for hashed in assets.values())
+    print(f"{len(assets)} assets, {sum(len(v) for v in variants.values())} image variants, {before / 1024:.0f} KB -> {after / 1024:.0f} KB")
+    if not HAS_PILLOW:
+        print("Pillow is not installed, images were only fingerprinted")
+    if not HAS_BROTLI:
+        print("brotli is not installed, css was only gzipped")
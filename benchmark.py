@@ -0,0 +1,158 @@
+"""End-to-end latency benchmark for the Flask routes against the offline Spotify stub.
+
+    python benchmark.py --iterations 50 --latency 40 --jitter 10
+    python benchmark.py --cold --json bench_output.json
+
+Reports p50/p95/p99 latency and upstream calls per request for each route. Nothing here
+touches the network, so results are comparable between runs. The app runs with its default rate
+limits and its background profile warm up, so the calls column also counts whatever the warm up
+sent while a request was running.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import requests
+
+import stub_server
+
+ROUTES = ["home", "artist", "wrapped"]
+
+
+def percentile(values, pct):
+    # nearest-rank, good enough for a few hundred samples
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def upstream_calls(base_url):
+    return sum(count for name, count in requests.get(f"{base_url}/__stats").json().items() if not name.startswith("injected"))
+
+
+def reset_caches(index):
+    # what a brand new process (or an expired cache) would see
+    index.response_cache.entries.clear()
+    index.artist_page_cache.entries.clear()
+    index.recently_played_cache.entries.clear()
+    index.artist_metadata_cache.entries.clear()
+    index.biggest_hits.value = None
+    index.following_indexes.indexes.entries.clear()
+    index.fragment_cache.fragments.entries.clear()
+    with index.history_store.connect() as conn:
+        conn.execute("DELETE FROM sync_state")
+    index.profile_warmer.cancel_pending()
+    index.profile_warmer.warmed_at.entries.clear()
+    with index.artist_profiles.connect() as conn:
+        conn.execute("DELETE FROM artist_profiles")
+
+
+def timed_get(client, path):
+    # reads the body chunk by chunk so streamed pages report their first byte as well as the whole page
+    started = time.perf_counter()
+    response = client.get(path, buffered=False)
+    first_byte = None
+    for _ in response.iter_encoded():
+        if first_byte is None:
+            first_byte = time.perf_counter() - started
+    response.close()
+    total = time.perf_counter() - started
+    return response, (first_byte if first_byte is not None else total) * 1000, total * 1000
+
+
+def run_route(client, index, base_url, path, iterations, warmup, cold):
+    for _ in range(warmup):
+        timed_get(client, path)
+
+    latencies = []
+    first_bytes = []
+    calls = []
+    errors = 0
+    for _ in range(iterations):
+        if cold:
+            reset_caches(index)
+        before = upstream_calls(base_url)
+
+        response, first_byte, latency = timed_get(client, path)
+        latencies.append(latency)
+        first_bytes.append(first_byte)
+
+        calls.append(upstream_calls(base_url) - before)
+        if response.status_code >= 400:
+            errors += 1
+
+    return {
+        "path": path,
+        "requests": iterations,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 2),
+        "ttfb_p50_ms": round(percentile(first_bytes, 50), 2),
+        "upstream_calls_per_request": round(sum(calls) / len(calls), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=40, help="mean stub latency in ms")
+    parser.add_argument("--jitter", type=float, default=10, help="+/- ms around the mean stub latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of upstream calls answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="fraction of upstream calls answered with 429")
+    parser.add_argument("--cold", action="store_true", help="clear every cache before each request")
+    parser.add_argument("--routes", default=",".join(ROUTES), help=f"comma separated, any of {', '.join(ROUTES)}")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    server, base_url = stub_server.start_in_thread(latency_ms=args.latency, jitter_ms=args.jitter)
+
+    # the app reads its upstreams and limits at import time, so set them up before importing it
+    workdir = tempfile.mkdtemp(prefix="soundspace-bench-")
+    os.environ.update({
+        "SPOTIFY_API_BASE": base_url,
+        "SPOTIFY_WEB_BASE": base_url,
+        "SPOTIFY_ACCOUNTS_BASE": base_url,
+        "HISTORY_DB": os.path.join(workdir, "history.db"),
+        "ARTIST_PROFILE_DB": os.path.join(workdir, "artist_profiles.db"),
+        "TOKEN_STORE": "memory",
+    })
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    import index
+
+    client = index.create_app().test_client()
+    login = client.get("/callback?code=benchmark")
+    if login.status_code != 302 or not login.location.endswith("/home"):
+        raise SystemExit("Could not log in against the stub server")
+
+    # errors only start once we are logged in, the token exchange is not retried
+    stub_server.config.update(error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
+
+    artist = stub_server.fixtures["artists"][3]
+    paths = {
+        "home": "/home",
+        "artist": f"/home?artist_id={artist['id']}&artist_name={artist['name']}",
+        "wrapped": "/wrapped",
+    }
+
+    results = []
+    for route in args.routes.split(","):
+        results.append(run_route(client, index, base_url, paths[route], args.iterations, args.warmup, args.cold))
+
+    print(f"{'route':<60} {'ttfb':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'calls':>6} {'errors':>6}")
+    for result in results:
+        print(f"{result['path'][:60]:<60} {result['ttfb_p50_ms']:>8} {result['p50_ms']:>8} {result['p95_ms']:>8} {result['p99_ms']:>8} {result['upstream_calls_per_request']:>6} {result['errors']:>6}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
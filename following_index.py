@@ -0,0 +1,120 @@
+import os
+import threading
+
+from http_client import background_requests
+from response_cache import LruCache
+
+FOLLOWING_INDEX_TTL = int(os.getenv("FOLLOWING_INDEX_TTL", 600))
+FOLLOWING_INDEX_USERS = int(os.getenv("FOLLOWING_INDEX_USERS", 1000))
+# past this many artists we stop paging and ask spotify about the ids we need instead
+FOLLOWING_INDEX_MAX_ARTISTS = int(os.getenv("FOLLOWING_INDEX_MAX_ARTISTS", 200))
+FOLLOWING_PAGE_SIZE = 50
+CONTAINS_BATCH_SIZE = 50
+
+
+class FollowingIndex:
+    # the artists one user follows, filled page by page through the following cursor and kept current by our own follow/unfollow
+    def __init__(self):
+        self.following = set()
+        self.not_following = set()
+        self.after = None
+        self.complete = False
+        self.loading = False
+        self.lock = threading.Lock()
+
+    def add_page(self, after, artist_ids, next_after):
+        # only a page that starts where the index stopped extends it, anything else would leave a gap
+        with self.lock:
+            if self.complete or after != self.after:
+                return
+            self.following.update(artist_ids)
+            self.not_following.difference_update(artist_ids)
+            self.after = next_after
+            self.complete = next_after is None
+
+    def load(self, spotify_api, max_artists=FOLLOWING_INDEX_MAX_ARTISTS):
+        # the page fetches happen outside self.lock so add_page from /home never waits on them
+        while True:
+            with self.lock:
+                if self.complete or len(self.following) >= max_artists:
+                    return
+                after = self.after
+            # get_followed_artists_page feeds the page back through add_page
+            if spotify_api.get_followed_artists_page(after, FOLLOWING_PAGE_SIZE) is None:
+                return
+            with self.lock:
+                if self.after == after:
+                    return
+
+    def load_in_background(self, spotify_api):
+        # pages through the followed artists on its own thread, a lookup never waits for it
+        with self.lock:
+            if self.loading or self.complete or len(self.following) >= FOLLOWING_INDEX_MAX_ARTISTS:
+                return
+            self.loading = True
+        threading.Thread(target=self.run_load, args=(spotify_api,), name="following-index", daemon=True).start()
+
+    def run_load(self, spotify_api):
+        # its calls wait behind the ones pages make
+        background_requests.set(True)
+        try:
+            self.load(spotify_api)
+        except Exception as e:
+            print(f"Error loading followed artists: {e}")
+        finally:
+            with self.lock:
+                self.loading = False
+
+    def followed(self, artist_id):
+        with self.lock:
+            self.following.add(artist_id)
+            self.not_following.discard(artist_id)
+
+    def unfollowed(self, artist_id):
+        with self.lock:
+            self.following.discard(artist_id)
+            self.not_following.add(artist_id)
+
+    def contains(self, spotify_api, artist_ids):
+        # {artist id: True/False}, None for ids spotify could not tell us about
+        # ids the index has not seen yet go to the batched contains call while the index fills up behind it
+        self.load_in_background(spotify_api)
+
+        answers = {}
+        unknown = []
+        with self.lock:
+            for artist_id in artist_ids:
+                if artist_id in self.following:
+                    answers[artist_id] = True
+                elif artist_id in self.not_following or self.complete:
+                    answers[artist_id] = False
+                else:
+                    unknown.append(artist_id)
+
+        for start in range(0, len(unknown), CONTAINS_BATCH_SIZE):
+            batch = unknown[start:start + CONTAINS_BATCH_SIZE]
+            result = spotify_api.get_following_contains(batch)
+            if result is None:
+                answers.update((artist_id, None) for artist_id in batch)
+                continue
+
+            with self.lock:
+                for artist_id, following in zip(batch, result):
+                    answers[artist_id] = following
+                    (self.following if following else self.not_following).add(artist_id)
+        return answers
+
+
+class FollowingIndexes:
+    # one index per user, dropped after FOLLOWING_INDEX_TTL so follows made outside the app show up eventually
+    def __init__(self, max_users=FOLLOWING_INDEX_USERS, ttl=FOLLOWING_INDEX_TTL):
+        self.indexes = LruCache(max_users, ttl)
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            index = self.indexes.get(user_id)
+            if index is None:
+                index = FollowingIndex()
+                self.indexes.set(user_id, index)
+            return index
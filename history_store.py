@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+
+from image_cache import pick_image
+
+HISTORY_DB = os.getenv("HISTORY_DB", "history.db")
+HISTORY_SYNC_INTERVAL = int(os.getenv("HISTORY_SYNC_INTERVAL", 60))
+HISTORY_WINDOW_DAYS = int(os.getenv("HISTORY_WINDOW_DAYS", 28))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plays (
+    user_id TEXT NOT NULL,
+    played_at INTEGER NOT NULL,
+    track_id TEXT NOT NULL,
+    track_name TEXT NOT NULL,
+    album_image TEXT,
+    artists TEXT NOT NULL,
+    PRIMARY KEY (user_id, played_at)
+);
+CREATE INDEX IF NOT EXISTS plays_user_played_at ON plays (user_id, played_at);
+
+CREATE TABLE IF NOT EXISTS daily_track_counts (
+    user_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    track_id TEXT NOT NULL,
+    track_name TEXT NOT NULL,
+    album_image TEXT,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day, track_id)
+);
+
+CREATE TABLE IF NOT EXISTS daily_artist_counts (
+    user_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    artist_id TEXT NOT NULL,
+    artist_name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day, artist_id)
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    user_id TEXT PRIMARY KEY,
+    after INTEGER NOT NULL,
+    synced_at REAL NOT NULL
+);
+"""
+
+
+def played_at_ms(played_at):
+    return int(datetime.fromisoformat(played_at.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+def day_of(ms):
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).strftime("%Y-%m-%d")
+
+
+class HistoryStore:
+    # every play we have seen per user, plus per-day counts so wrapped never has to scan the raw plays
+    def __init__(self, path=HISTORY_DB):
+        self.path = path
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get_sync_state(self, user_id):
+        with self.connect() as conn:
+            row = conn.execute("SELECT after, synced_at FROM sync_state WHERE user_id = ?", (user_id,)).fetchone()
+        return row if row else (None, 0)
+
+    def add_plays(self, user_id, items, after):
+        added = 0
+        with self.connect() as conn:
+            for item in items:
+                track = item["track"]
+                played_at = played_at_ms(item["played_at"])
+                day = day_of(played_at)
+                # stored plays are only shown on wrapped
+                album_image = pick_image(track["album"]["images"], "wrapped")
+                artists = [{"id": artist["id"], "name": artist["name"]} for artist in track["artists"]]
+
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO plays (user_id, played_at, track_id, track_name, album_image, artists) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, played_at, track["id"], track["name"], album_image, json.dumps(artists))
+                )
+                # the rolling counts only move for plays we had not stored yet
+                if cursor.rowcount != 1:
+                    continue
+                added += 1
+
+                conn.execute(
+                    """INSERT INTO daily_track_counts (user_id, day, track_id, track_name, album_image, count) VALUES (?, ?, ?, ?, ?, 1)
+                    ON CONFLICT (user_id, day, track_id) DO UPDATE SET count = count + 1, track_name = excluded.track_name, album_image = excluded.album_image""",
+                    (user_id, day, track["id"], track["name"], album_image)
+                )
+                for artist in artists:
+                    conn.execute(
+                        """INSERT INTO daily_artist_counts (user_id, day, artist_id, artist_name, count) VALUES (?, ?, ?, ?, 1)
+                        ON CONFLICT (user_id, day, artist_id) DO UPDATE SET count = count + 1, artist_name = excluded.artist_name""",
+                        (user_id, day, artist["id"], artist["name"])
+                    )
+
+            conn.execute(
+                "INSERT OR REPLACE INTO sync_state (user_id, after, synced_at) VALUES (?, ?, ?)",
+                (user_id, after, time.time())
+            )
+        return added
+
+    def sync(self, spotify_api, force=False):
+        # only asks spotify for plays newer than the last cursor we stored
+        user_id = spotify_api.get_user_key()
+        after, synced_at = self.get_sync_state(user_id)
+
+        if not force and time.time() - synced_at < HISTORY_SYNC_INTERVAL:
+            return 0
+
+        added = 0
+        while True:
+            page = spotify_api.get_recently_played_page(after=after)
+            if page is None:
+                break
+
+            items = page.get("items", [])
+            if items:
+                after = max(played_at_ms(item["played_at"]) for item in items)
+            elif after is None:
+                after = int(time.time() * 1000)
+            added += self.add_plays(user_id, items, after)
+
+            if len(items) < 50:
+                break
+        return added
+
+    def window_start(self, days):
+        return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+
+    def top_tracks(self, user_id, days=HISTORY_WINDOW_DAYS, limit=5):
+        with self.connect() as conn:
+            rows = conn.execute(
+                """SELECT track_id, MAX(track_name), MAX(album_image), SUM(count) AS plays FROM daily_track_counts
+                WHERE user_id = ? AND day >= ? GROUP BY track_id ORDER BY plays DESC LIMIT ?""",
+                (user_id, self.window_start(days), limit)
+            ).fetchall()
+        return [{"name": name, "image": image, "count": count} for _, name, image, count in rows]
+
+    def artist_play_count(self, user_id, days=HISTORY_WINDOW_DAYS, limit=10):
+        with self.connect() as conn:
+            rows = conn.execute(
+                """SELECT artist_id, MAX(artist_name), SUM(count) AS plays FROM daily_artist_counts
+                WHERE user_id = ? AND day >= ? GROUP BY artist_id ORDER BY plays DESC LIMIT ?""",
+                (user_id, self.window_start(days), limit)
+            ).fetchall()
+        return {artist_id: {"name": name, "count": count} for artist_id, name, count in rows}
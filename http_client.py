@@ -0,0 +1,293 @@
+import contextvars
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from instrumentation import record_upstream
+
+load_dotenv()
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 3.05))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10))
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", 3))
+BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", 0.3))
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 16))
+RATE_LIMIT = float(os.getenv("HTTP_RATE_LIMIT", 10))  # requests per second per host
+RATE_BURST = int(os.getenv("HTTP_RATE_BURST", 20))
+# background work (profile warm ups) gets its own, lower rate per host and never takes the last tokens of the page bucket
+BACKGROUND_RATE_LIMIT = float(os.getenv("HTTP_BACKGROUND_RATE_LIMIT", 2))
+BACKGROUND_RESERVE = int(os.getenv("HTTP_BACKGROUND_RESERVE", RATE_BURST // 2))
+MAX_RETRY_AFTER = float(os.getenv("HTTP_MAX_RETRY_AFTER", 10))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+RETRY_STATUSES = {500, 502, 503, 504}
+RETRY_METHODS = {"GET", "PUT", "DELETE"}
+
+# set per page render, every upstream call made for that page shares what is left of it
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+# set by threads that work for nobody in particular, their calls yield to the ones pages are waiting on
+background_requests = contextvars.ContextVar("background_requests", default=False)
+
+
+class DeadlineExceeded(requests.Timeout):
+    pass
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    # stops calling a host after repeated failures, then lets a single trial call through once it has cooled down
+    def __init__(self, host, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return
+        raise CircuitOpenError(f"Circuit open for {self.host}, not calling it for now")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_abandoned(self):
+        # the call gave up for its own reasons (a page out of time), it says nothing about the host
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    print(f"Opening circuit for {self.host} after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+
+class TokenBucket:
+    # refills at `rate` tokens per second up to `capacity`, and can be paused when the host tells us to back off
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None, reserve=0):
+        # reserve tokens are left in the bucket for other callers
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if now >= self.blocked_until and self.tokens >= 1 + reserve:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.blocked_until - now, (1 + reserve - self.tokens) / self.rate)
+            if deadline is not None and wait >= deadline.remaining():
+                raise DeadlineExceeded("No time left to wait for the rate limit")
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class HttpClient:
+    # one keep-alive session per host, shared by every SpotifyApi instance
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff_factor=BACKOFF_FACTOR, pool_size=POOL_SIZE, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.rate = rate
+        self.burst = burst
+        self.sessions = {}
+        self.deadline_sessions = {}
+        self.buckets = {}
+        self.background_buckets = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def new_session(self, retries=True):
+        # calls made under a deadline retry in request() instead, urllib3 would give every retry the full timeout again
+        retry = Retry(
+            total=self.max_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=sorted(RETRY_STATUSES),
+            allowed_methods=sorted(RETRY_METHODS),
+            raise_on_status=False
+        ) if retries else 0
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def for_host(self, host, deadline=None):
+        with self.lock:
+            if host not in self.sessions:
+                self.sessions[host] = self.new_session()
+                self.deadline_sessions[host] = self.new_session(retries=False)
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+                self.background_buckets[host] = TokenBucket(BACKGROUND_RATE_LIMIT, 1)
+                self.breakers[host] = CircuitBreaker(host)
+            sessions = self.sessions if deadline is None else self.deadline_sessions
+            return sessions[host], self.buckets[host], self.breakers[host]
+
+    def retry_after(self, response, attempt):
+        value = response.headers.get("Retry-After")
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            seconds = self.backoff_factor * (2 ** attempt)
+        return min(seconds, MAX_RETRY_AFTER)
+
+    def timeout_for(self, deadline):
+        if deadline is None:
+            return self.timeout
+        remaining = deadline.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("No time left for this call")
+        return (min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+
+    def send(self, session, breaker, method, url, cache, endpoint, **kwargs):
+        breaker.before_call()
+
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.Timeout:
+            # a timeout we cut short to fit the page's budget is not the host's fault, it must not open the circuit for everyone
+            if tuple(kwargs["timeout"]) < self.timeout:
+                breaker.record_abandoned()
+            else:
+                breaker.record_failure()
+            record_upstream(method, url, "error", 0, time.perf_counter() - started, cache, endpoint)
+            raise
+        except requests.RequestException:
+            breaker.record_failure()
+            record_upstream(method, url, "error", 0, time.perf_counter() - started, cache, endpoint)
+            raise
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        record_upstream(method, url, response.status_code, len(response.content), time.perf_counter() - started, cache, endpoint)
+        return response
+
+    def backoff(self, deadline, attempt):
+        # False when the page would run out of time before the next attempt could start
+        wait = self.backoff_factor * (2 ** attempt)
+        if wait >= deadline.remaining():
+            return False
+        time.sleep(wait)
+        return True
+
+    def acquire(self, host, bucket, deadline):
+        if not background_requests.get():
+            bucket.acquire(deadline)
+            return
+        self.background_buckets[host].acquire(deadline)
+        bucket.acquire(deadline, reserve=min(BACKGROUND_RESERVE, bucket.capacity - 1))
+
+    def request(self, method, url, cache="none", endpoint=None, **kwargs):
+        deadline = current_deadline.get()
+        host = urlsplit(url).netloc
+        session, bucket, breaker = self.for_host(host, deadline)
+        # without a deadline urllib3 retries errors and 5xx, with one we do it here so every attempt fits what is left
+        retry_here = deadline is not None and method in RETRY_METHODS
+
+        attempt = 0
+        while True:
+            self.acquire(host, bucket, deadline)
+            kwargs["timeout"] = self.timeout_for(deadline)
+            try:
+                response = self.send(session, breaker, method, url, cache, endpoint, **kwargs)
+            except CircuitOpenError:
+                raise
+            except (requests.ConnectionError, requests.Timeout):
+                if not retry_here or attempt >= self.max_retries or not self.backoff(deadline, attempt):
+                    raise
+                attempt += 1
+                continue
+
+            if retry_here and response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                if not self.backoff(deadline, attempt):
+                    return response
+                attempt += 1
+                continue
+
+            if response.status_code != 429 or attempt >= self.max_retries:
+                return response
+
+            # the whole host is rate limited, not just this call, so hold every caller back
+            wait = self.retry_after(response, attempt)
+            if deadline is not None and wait >= deadline.remaining():
+                return response
+            print(f"Rate limited by {urlsplit(url).netloc}, retrying in {wait}s")
+            bucket.pause(wait)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+http = HttpClient()
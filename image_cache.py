@@ -0,0 +1,192 @@
+import hashlib
+import importlib.util
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from response_cache import KeyLocks
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_MB", 200)) * 1024 * 1024
+# only spotify's image hosts are proxied, so /img cannot be used to fetch anything else
+IMAGE_PROXY_HOSTS = set(os.getenv("IMAGE_PROXY_HOSTS", "i.scdn.co,mosaic.scdn.co,image-cdn-ak.spotifycdn.com,image-cdn-fa.spotifycdn.com,thisis-images.spotifycdn.com").split(","))
+# last_used is only rewritten this often, a hit should not always cost a write
+TOUCH_INTERVAL = 60
+
+# the box each kind of image is shown in (home.css, wrapped.css), doubled for high density screens
+THUMB_WIDTHS = {"artist": 176, "album": 200, "track": 448, "wrapped": 608}
+
+HAS_PILLOW = importlib.util.find_spec("PIL") is not None
+
+
+def pick_image(images, kind):
+    # spotify lists 640, 300 and 64 px renditions, the smallest one that still fills the box is enough
+    if not images:
+        return None
+    width = THUMB_WIDTHS[kind]
+    big_enough = [image for image in images if (image.get("width") or 0) >= width]
+    return min(big_enough, key=lambda image: image["width"])["url"] if big_enough else images[0]["url"]
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thumbnails (
+    url TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (url, width, format)
+);
+CREATE INDEX IF NOT EXISTS thumbnails_last_used ON thumbnails (last_used);
+CREATE INDEX IF NOT EXISTS thumbnails_digest ON thumbnails (digest);
+"""
+
+Thumbnail = namedtuple("Thumbnail", ["path", "digest", "content_type"])
+
+
+def thumbnail_width(width):
+    # snaps any requested width to one we actually use, so the cache cannot be filled with arbitrary sizes
+    widths = sorted(THUMB_WIDTHS.values())
+    if not width:
+        return widths[-1]
+    return next((known for known in widths if known >= width), widths[-1])
+
+
+def output_format(accept_mimetypes):
+    if not HAS_PILLOW:
+        return "original"
+    return "webp" if accept_mimetypes["image/webp"] else "jpeg"
+
+
+def make_thumbnail(data, width, fmt):
+    # (bytes, content type), the original untouched when Pillow is missing or it is already small enough
+    if fmt == "original":
+        return data, sniff_content_type(data)
+
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, fmt.upper(), quality=82)
+        return buffer.getvalue(), f"image/{fmt}"
+
+
+def sniff_content_type(data):
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    return "image/jpeg"
+
+
+class ImageCache:
+    # thumbnails stored by the hash of their bytes, with a small sqlite index from (url, width, format) to the hash
+    # total size is kept under max_bytes by dropping the least recently used entries
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "index.db")
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+        self.fetch_locks = KeyLocks()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def lookup(self, url, width, fmt):
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT digest, content_type, last_used FROM thumbnails WHERE url = ? AND width = ? AND format = ?",
+                (url, width, fmt)
+            ).fetchone()
+            if row is None or not os.path.exists(self.blob_path(row[0])):
+                return None
+
+            if time.time() - row[2] > TOUCH_INTERVAL:
+                conn.execute("UPDATE thumbnails SET last_used = ? WHERE url = ? AND width = ? AND format = ?", (time.time(), url, width, fmt))
+        return Thumbnail(self.blob_path(row[0]), row[0], row[1])
+
+    def store(self, url, width, fmt, data, content_type):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written under a temporary name first so a reader never sees half a file
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO thumbnails (url, width, format, digest, content_type, size, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, width, fmt, digest, content_type, len(data), time.time())
+            )
+        self.evict(keep=(url, width, fmt))
+        return Thumbnail(path, digest, content_type)
+
+    def total_bytes(self, conn):
+        # identical thumbnails share one file, so each hash only counts once
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT digest, MAX(size) AS size FROM thumbnails GROUP BY digest)").fetchone()[0]
+
+    def evict(self, keep=None):
+        # keep is the entry that was just stored, it is about to be served
+        url, width, fmt = keep or (None, None, None)
+        with self.connect() as conn:
+            total = self.total_bytes(conn)
+            while total > self.max_bytes:
+                row = conn.execute(
+                    "SELECT url, width, format, digest FROM thumbnails WHERE NOT (url IS ? AND width IS ? AND format IS ?) ORDER BY last_used LIMIT 1",
+                    (url, width, fmt)
+                ).fetchone()
+                if row is None:
+                    break
+                conn.execute("DELETE FROM thumbnails WHERE url = ? AND width = ? AND format = ?", row[:3])
+                digest = row[3]
+                if not conn.execute("SELECT 1 FROM thumbnails WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+                    try:
+                        os.remove(self.blob_path(digest))
+                    except FileNotFoundError:
+                        pass
+                total = self.total_bytes(conn)
+
+    def stats(self):
+        with self.connect() as conn:
+            entries = conn.execute("SELECT COUNT(*) FROM thumbnails").fetchone()[0]
+            return {"entries": entries, "bytes": self.total_bytes(conn), "max_bytes": self.max_bytes}
+
+    def thumbnail(self, url, width, fmt, fetch):
+        # fetch() returns the original image bytes or None, it only runs on a miss and once per thumbnail at a time
+        cached = self.lookup(url, width, fmt)
+        if cached:
+            return cached
+
+        with self.fetch_locks.hold((url, width, fmt)):
+            cached = self.lookup(url, width, fmt)
+            if cached:
+                return cached
+
+            data = fetch()
+            if data is None:
+                return None
+            try:
+                thumbnail, content_type = make_thumbnail(data, width, fmt)
+            except Exception as e:
+                print(f"Could not resize {url}: {e}")
+                thumbnail, content_type = data, sniff_content_type(data)
+            return self.store(url, width, fmt, thumbnail, content_type)
@@ -1,16 +1,26 @@
-from requests import post, get
-from bs4 import BeautifulSoup
-import requests
 import json
+import mimetypes
 from dotenv import load_dotenv
 import os
-from flask import Flask, request, redirect, render_template, url_for
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
+import contextvars
+from flask import Flask, request, redirect, render_template, url_for, session, g, Response, stream_with_context, get_template_attribute, send_from_directory, send_file
+from urllib.parse import urlsplit
+
+from http_client import http, Deadline, current_deadline
+from token_store import make_token_store
+from response_cache import response_cache, LruCache, KeyLocks, SharedDataset
+from history_store import HistoryStore
+from following_index import FollowingIndexes
+from artist_store import ArtistProfileStore, ArtistProfileWarmer
+from scraping import scraper, ArtistPage, HomePage
+from instrumentation import metrics, request_timings, record_upstream, server_timing_header
+from assets import AssetManifest
+from image_cache import ImageCache, THUMB_WIDTHS, IMAGE_PROXY_HOSTS, pick_image, thumbnail_width, output_format
+from page_cache import FragmentCache, fingerprint, files_version, compress_response
 
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
 import time
+import threading
 
 app = Flask(__name__)
 
@@ -21,17 +31,215 @@ client_secret = os.getenv("CLIENT_SECRET")
 redirect_uri = os.getenv("REDIRECT_URI") 
 port = os.getenv("PORT")
 
+# point these at stub_server.py to run without the real spotify
+api_base = os.getenv("SPOTIFY_API_BASE", "https://api.spotify.com")
+web_base = os.getenv("SPOTIFY_WEB_BASE", "https://open.spotify.com")
+accounts_base = os.getenv("SPOTIFY_ACCOUNTS_BASE", "https://accounts.spotify.com")
+
+app.secret_key = os.getenv("SECRET_KEY")
+if not app.secret_key:
+    # sessions only survive this process, every worker needs the same SECRET_KEY to share logins
+    print("SECRET_KEY is not set, using a random one")
+    app.secret_key = os.urandom(24).hex()
+
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", 60))
+
+# connected by create_app, importing this module does not touch redis, sqlite or the disk
+token_store = None
+history_store = None
+image_cache = None
+artist_profiles = None
+profile_warmer = None
+page_version = None
+startup_lock = threading.Lock()
+
+def create_app():
+    # entry point for servers, e.g. gunicorn "index:create_app()"
+    # routes are registered on the module level app, this sets up what they need the first time and hands it back
+    global token_store, history_store, image_cache, artist_profiles, profile_warmer, page_version
+    with startup_lock:
+        if token_store is None:
+            token_store = make_token_store(os.getenv("TOKEN_STORE", "memory"))
+        if history_store is None:
+            history_store = HistoryStore()
+        if image_cache is None:
+            image_cache = ImageCache()
+        if artist_profiles is None:
+            artist_profiles = ArtistProfileStore()
+            profile_warmer = ArtistProfileWarmer(artist_profiles, load_artist_profiles, artist_ids_to_warm)
+        if page_version is None:
+            page_version = files_version(os.path.join(app.root_path, app.template_folder), asset_manifest.path)
+    return app
+
+# shared pool for running independent upstream calls side by side
+fetch_pool = ThreadPoolExecutor(max_workers=int(os.getenv("FETCH_WORKERS", 8)))
+
+def submit(fn, *args):
+    # run in a copy of the caller's context so upstream timings and the deadline land on the right request
+    return fetch_pool.submit(contextvars.copy_context().run, fn, *args)
+
+# how long a page may wait on spotify before it renders whatever it has
+HOME_DEADLINE = float(os.getenv("HOME_DEADLINE", 3))
+WRAPPED_DEADLINE = float(os.getenv("WRAPPED_DEADLINE", 3))
+
+def start_deadline(seconds):
+    deadline = Deadline(seconds)
+    g.deadline = deadline
+    g.degraded = set()
+    g.deadline_token = current_deadline.set(deadline)
+    return deadline
+
+def panel_result(future, panel):
+    # a panel that is late or failed renders as a placeholder instead of holding up the page
+    try:
+        return future.result(timeout=g.deadline.remaining())
+    except FutureTimeoutError:
+        print(f"{panel} missed the deadline")
+    except Exception as e:
+        print(f"Error loading {panel}: {e}")
+
+    g.degraded.add(panel)
+    metrics.inc("soundspace_degraded_panels_total", [("route", request.url_rule.rule), ("panel", panel)])
+    return None
+
+following_indexes = FollowingIndexes()
+
+# rendered pages and home panels, keyed by the data they were rendered from
+fragment_cache = FragmentCache()
+
+def page_response(spotify_api, name, data, render):
+    # the ETag is per user and covers everything the page is rendered from, a visit with nothing new is a 304 without rendering
+    etag = fingerprint(name, page_version, spotify_api.get_user_key(), data)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(fragment_cache.render((name, etag), render), mimetype="text/html")
+
+    # weak, the same page goes out as gzip, brotli or plain
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
+RECENTLY_PLAYED_TTL = int(os.getenv("RECENTLY_PLAYED_TTL", 30))
+
+class RecentlyPlayedSnapshot:
+    # walks the recently-played items once and keeps every view the pages need
+    def __init__(self, items):
+        self.artist_play_count = {}
+        self.recent_tracks = []
+
+        track_play_count = {}  # Dictionary to keep track of play counts
+        seen_tracks = set()  # Set to keep track of seen track IDs
+
+        for index, item in enumerate(items):
+            track = item['track']
+            track_id = track['id']
+
+            # Increment the play count for the track
+            if track_id in track_play_count:
+                track_play_count[track_id]['count'] += 1
+            else:
+                # the play counts end up on wrapped
+                track_play_count[track_id] = {
+                    "name": track['name'],
+                    "image": pick_image(track['album']['images'], "wrapped"),
+                    "count": 1
+                }
+
+            # only the 12 latest plays are shown as recently played
+            if index < 12 and track_id not in seen_tracks:
+                seen_tracks.add(track_id)
+                self.recent_tracks.append({
+                    "name": track['name'],
+                    "id": track_id,
+                    "image": pick_image(track['album']['images'], "track")
+                })
+
+            # keyed by id so wrapped can look the artists up in one batch instead of searching names
+            for artist in track['artists']:
+                if artist['id'] in self.artist_play_count:
+                    self.artist_play_count[artist['id']]['count'] += 1
+                else:
+                    self.artist_play_count[artist['id']] = {
+                        "name": artist['name'],
+                        "count": 1
+                    }
+
+        # Sort the tracks by play count in descending order and get the top 5
+        self.top_tracks = sorted(track_play_count.values(), key=lambda x: x['count'], reverse=True)[:5]
+
+ARTIST_PAGE_TTL = int(os.getenv("ARTIST_PAGE_TTL", 600))
+
+class ArtistPageSnapshot:
+    # everything we scrape from open.spotify.com/artist/{id}, pulled out of a single parse
+    def __init__(self, artist_id, html_content):
+        self.artist_id = artist_id
+        self.fetched_at = time.time()
+
+        fields, self.backend, self.parse_time = scraper.extract(html_content, ArtistPage(artist_id))
+        self.about = fields["about"]
+        self.monthly_listeners = fields["monthly_listeners"]
+        self.banner = fields["banner"]
+        self.track_plays = fields["track_plays"]
+
+        if not self.about:
+            print("About element not found.")
+
+    @classmethod
+    def fetch(cls, artist_id, client=http):
+        url = f'{web_base}/artist/{artist_id}'
+        response = client.get(url)
+
+        if response.status_code != 200:
+            print(f"Error getting artist page: {response.status_code}")
+            return None
+
+        return cls(artist_id, response.content)
+
+# artist pages are public, so one cache serves every user
+# bounded, the artist id comes straight from the query string
+artist_page_cache = LruCache(int(os.getenv("ARTIST_PAGE_CACHE_SIZE", 1000)), ARTIST_PAGE_TTL)
+artist_page_locks = KeyLocks()
+
+# artist names and images barely change, keep them around for a day
+ARTIST_METADATA_TTL = int(os.getenv("ARTIST_METADATA_TTL", 24 * 3600))
+artist_metadata_cache = LruCache(int(os.getenv("ARTIST_METADATA_CACHE_SIZE", 5000)), ARTIST_METADATA_TTL)
+
+# recently played is per user, keyed by the spotify user id
+recently_played_cache = LruCache(int(os.getenv("RECENTLY_PLAYED_CACHE_SIZE", 1000)), RECENTLY_PLAYED_TTL)
+recently_played_locks = KeyLocks()
+
 class SpotifyApi:
-    def __init__(self):
-        self.token = None
+    def __init__(self, token=None, refresh_token=None, expires_at=None, user_id=None, client=http):
+        self.token = token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.user_id = user_id
+        self.http = client
+
+    @classmethod
+    def from_record(cls, record, client=http):
+        return cls(record["access_token"], record.get("refresh_token"), record.get("expires_at"), record.get("user_id"), client)
+
+    def to_record(self):
+        return {
+            "access_token": self.token,
+            "refresh_token": self.refresh_token,
+            "expires_at": self.expires_at,
+            "user_id": self.user_id
+        }
+
+    def get_user_key(self):
+        return self.user_id or self.token
 
     def get_auth_url(self):
         scope = "user-read-recently-played user-follow-read user-library-read user-follow-modify"
-        auth_url = f"https://accounts.spotify.com/authorize?response_type=code&client_id={client_id}&redirect_uri={redirect_uri}&scope={scope}"
+        auth_url = f"{accounts_base}/authorize?response_type=code&client_id={client_id}&redirect_uri={redirect_uri}&scope={scope}"
         return auth_url
 
     def get_token(self, auth_code):
-        url = "https://accounts.spotify.com/api/token"
+        url = f"{accounts_base}/api/token"
         headers = {
             "Content-Type": "application/x-www-form-urlencoded"
         }
@@ -42,28 +250,103 @@ class SpotifyApi:
             "client_id": client_id,
             "client_secret": client_secret
         }
-        result = post(url, headers=headers, data=data)
+        result = self.http.post(url, headers=headers, data=data)
         
         if result.status_code != 200:
             print(f"Error getting token: {result.content}")
             return None
         
         json_result = json.loads(result.content)
-        self.token = json_result["access_token"]
+        self.set_token_data(json_result)
+        return self.token
+
+    def refresh_access_token(self):
+        url = f"{accounts_base}/api/token"
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
+        data = {
+            "grant_type": "refresh_token",
+            "refresh_token": self.refresh_token,
+            "client_id": client_id,
+            "client_secret": client_secret
+        }
+        result = self.http.post(url, headers=headers, data=data)
+
+        if result.status_code != 200:
+            print(f"Error refreshing token: {result.content}")
+            return None
+
+        json_result = json.loads(result.content)
+        self.set_token_data(json_result)
         return self.token
+
+    def set_token_data(self, json_result):
+        self.token = json_result["access_token"]
+        # spotify only sometimes rotates the refresh token, keep the old one otherwise
+        self.refresh_token = json_result.get("refresh_token", self.refresh_token)
+        self.expires_at = time.time() + json_result.get("expires_in", 3600)
+
+    def token_expires_soon(self):
+        return self.expires_at is not None and self.expires_at - TOKEN_REFRESH_MARGIN < time.time()
+
+    def get_current_user_id(self):
+        url = f"{api_base}/v1/me"
+        headers = self.get_auth_header()
+
+        result = self.http.get(url, headers=headers)
+
+        if result.status_code != 200:
+            print(f"Error getting current user: {result.content}")
+            return None
+
+        self.user_id = json.loads(result.content)["id"]
+        return self.user_id
     
     def get_auth_header(self):
         return {"Authorization": "Bearer " + self.token}
 
+    def cached_get(self, endpoint, url, headers, shared=False, fresh=False):
+        # shared responses (search, top tracks) look the same for everyone, so they are not keyed by user
+        # fresh always asks spotify, revalidating what we have
+        key = (None if shared else self.get_user_key(), endpoint, url)
+        entry = response_cache.get(key)
+
+        if entry and entry.is_fresh() and not fresh:
+            response_cache.record(endpoint, "hits")
+            record_upstream("GET", url, entry.response.status_code, 0, 0, "hit")
+            return entry.response
+
+        response_cache.record(endpoint, "misses")
+        if entry and entry.etag:
+            headers = {**headers, "If-None-Match": entry.etag}
+
+        result = self.http.get(url, headers=headers, cache="miss")
+
+        if result.status_code == 304 and entry:
+            response_cache.record(endpoint, "revalidated")
+            response_cache.touch(key)
+            return entry.response
+
+        if result.status_code == 200:
+            response_cache.set(key, result)
+        return result
+
+    def invalidate_following(self):
+        response_cache.invalidate(self.get_user_key(), "followed_artists", "following_contains")
+
+    def following_index(self):
+        return following_indexes.get(self.get_user_key())
+
     def search_for_artist(self, artist_name):
         if artist_name:
             try:
-                url = "https://api.spotify.com/v1/search?"
+                url = f"{api_base}/v1/search?"
                 headers = self.get_auth_header()
                 query = f"q={artist_name}&type=artist&limit=1"
                 
                 query_url = url + query
-                result = get(query_url, headers=headers)
+                result = self.cached_get("artist_search", query_url, headers, shared=True)
                 
                 if result.status_code != 200:
                     print(f"Error searching for artist: {result.content}")
@@ -101,28 +384,24 @@ class SpotifyApi:
         return artist_data["name"]
     
     def get_artist_image(self, artist_data):
-        return artist_data["images"][0]["url"] if artist_data and "images" in artist_data and artist_data["images"] else None
+        # wrapped is the one page that shows this picture
+        return pick_image(artist_data.get("images"), "wrapped") if artist_data else None
 
-    def get_artist_about(self, artist_id):
-        url = f'https://open.spotify.com/artist/{artist_id}' 
-    
-        response = requests.get(url)
-        html_content = response.content
-   
-        soup = BeautifulSoup(html_content, 'html.parser')
+    def get_artist_page(self, artist_id, fresh=False):
+        # about, monthly listeners, plays and banner all come from the same page, download and parse it once
+        with artist_page_locks.hold(artist_id):
+            cached = artist_page_cache.get(artist_id)
+            if cached and not fresh:
+                return cached
 
-        div_element = soup.find('div', class_='Zbad_ytC5aqG3ZISd4Gw')
+            snapshot = ArtistPageSnapshot.fetch(artist_id, self.http)
+            if snapshot:
+                artist_page_cache.set(artist_id, snapshot)
+            return snapshot
 
-        if div_element:
-            span_element = div_element.find('span')
-            
-            if span_element:
-                text_content = span_element.get_text(strip=True)  # strip=True removes leading/trailing whitespace
-                return text_content
-            else:
-                print("Span element not found.")
-        else:
-            print("Div element not found.")
+    def get_artist_about(self, artist_id):
+        snapshot = self.get_artist_page(artist_id)
+        return snapshot.about if snapshot else None
             
     def convert_milliseconds_to_string(self, milliseconds):
         # Convert milliseconds to seconds
@@ -136,13 +415,13 @@ class SpotifyApi:
         # Return formatted string
         return f"{hours}h {minutes}m {remaining_seconds}s"
 
-    def get_songs_by_artist(self, artist_id):
-        url = f"https://api.spotify.com/v1/artists/{artist_id}/top-tracks?country=PH"
+    def get_songs_by_artist(self, artist_id, fresh=False):
+        url = f"{api_base}/v1/artists/{artist_id}/top-tracks?country=PH"
         headers = self.get_auth_header()
         
         output = []
         
-        result = get(url, headers=headers)
+        result = self.cached_get("artist_top_tracks", url, headers, shared=True, fresh=fresh)
         
         if result.status_code != 200:
             print(f"Error getting songs: {result.content}")
@@ -162,22 +441,16 @@ class SpotifyApi:
         return output
     
     def get_song_duration_and_listeners(self, artist_id):
-        url = f"https://open.spotify.com/artist/{artist_id}"
-        response = requests.get(url)
+        snapshot = self.get_artist_page(artist_id)
         songs = []
         songs = self.get_songs_by_artist(artist_id)
 
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            spans = soup.find_all('span', class_='Hj3ST6Lg66UEtynHfOT8')
-            paragraphs = soup.find_all('p', class_='e-9640-text encore-text-body-small encore-internal-color-text-subdued ListRowDetails__ListRowDetailText-sc-sozu4l-0 hxCObm')
-
+        if snapshot:
             results = []
             
-            for span, paragraph, song in zip(spans, paragraphs, songs):
-                title =  span.text.strip()
-                plays = paragraph.text.strip()
+            for track, song in zip(snapshot.track_plays, songs):
+                title = track["title"]
+                plays = track["plays"]
 
                 duration_ms = song["duration_ms"]
                 total_seconds = duration_ms / 1000
@@ -197,280 +470,347 @@ class SpotifyApi:
         
         return None
 
-    def get_recently_played_tracks(self):
-        url = "https://api.spotify.com/v1/me/player/recently-played"
-        headers = self.get_auth_header()
-        
-        result = get(url, headers=headers)
-        
-        if result.status_code != 200:
-            print(f"Error getting recently played tracks: {result.content}")
-            return None
-        
-        recently_played_tracks = json.loads(result.content)["items"]
-        
-        artist_play_count = {}
+    def get_recently_played_snapshot(self):
+        # /home and /wrapped both need this several times per page, fetch it once per user and reuse it briefly
+        user_key = self.get_user_key()
+        with recently_played_locks.hold(user_key):
+            cached = recently_played_cache.get(user_key)
+            if cached:
+                return cached
 
-        for track in recently_played_tracks:
-            track_artists = track['track']['artists']
+            url = f"{api_base}/v1/me/player/recently-played"
+            headers = self.get_auth_header()
             
-            for artist in track_artists:
-                artist_name = artist['name']
-                if artist_name in artist_play_count:
-                    artist_play_count[artist_name] += 1
-                else:
-                    artist_play_count[artist_name] = 1
-        
-        return artist_play_count 
-    
-    def getTop5Tracks(self):
-        url = "https://api.spotify.com/v1/me/player/recently-played"
+            result = self.http.get(url, headers=headers)
+            
+            if result.status_code != 200:
+                print(f"Error getting recently played tracks: {result.content}")
+                return None
+            
+            snapshot = RecentlyPlayedSnapshot(json.loads(result.content)["items"])
+            recently_played_cache.set(user_key, snapshot)
+            return snapshot
+
+    def get_recently_played_page(self, after=None, limit=50):
+        url = f"{api_base}/v1/me/player/recently-played?limit={limit}"
+        if after is not None:
+            url += f"&after={after}"
         headers = self.get_auth_header()
-        
-        result = get(url, headers=headers)
-        
+
+        result = self.http.get(url, headers=headers)
+
         if result.status_code != 200:
             print(f"Error getting recently played tracks: {result.content}")
             return None
-        
-        recently_played_tracks = json.loads(result.content)["items"]
-        
-        track_play_count = {}  # Dictionary to keep track of play counts
 
-        for track in recently_played_tracks:
-            track_name = track['track']['name']
-            track_id = track['track']['id']
-            album_image = track['track']['album']['images'][0]['url'] if track['track']['album']['images'] else None
-            
-            # Increment the play count for the track
-            if track_id in track_play_count:
-                track_play_count[track_id]['count'] += 1
-            else:
-                track_play_count[track_id] = {
-                    "name": track_name,
-                    "image": album_image,
-                    "count": 1
-                }
-        
-        # Sort the tracks by play count in descending order and get the top 5
-        sorted_tracks = sorted(track_play_count.values(), key=lambda x: x['count'], reverse=True)[:5]
-        
-        return sorted_tracks
+        return json.loads(result.content)
+
+    def get_recently_played_tracks(self):
+        snapshot = self.get_recently_played_snapshot()
+        return snapshot.artist_play_count if snapshot else None
+    
+    def getTop5Tracks(self):
+        snapshot = self.get_recently_played_snapshot()
+        return snapshot.top_tracks if snapshot else None
     
     def getRecentlyPlayedTracks(self):
-        url = "https://api.spotify.com/v1/me/player/recently-played"
+        snapshot = self.get_recently_played_snapshot()
+        return snapshot.recent_tracks if snapshot else None
+
+    def get_followed_artists_page(self, after=None, limit=5):
+        url = f"{api_base}/v1/me/following?type=artist&limit={limit}" 
+        if after:
+            url += f"&after={after}"
         headers = self.get_auth_header()
         
-        result = get(url, headers=headers)
+        result = self.cached_get("followed_artists", url, headers)
         
         if result.status_code != 200:
-            print(f"Error getting recently played tracks: {result.content}")
+            print(f"Error getting followed artists: {result.content}")
             return None
         
-        recently_played_tracks = json.loads(result.content)["items"]
+        json_result = json.loads(result.content)["artists"]
         
-        track_info_list = []
-        seen_tracks = set()  # Set to keep track of seen track IDs
+        page = {
+            "items": [{
+                "id": artist["id"],
+                "name": artist["name"],
+                "genres": artist["genres"],
+                "popularity": artist["popularity"],
+                "external_url": artist["external_urls"]["spotify"],
+                "image": pick_image(artist["images"], "artist")
+            } for artist in json_result["items"]],
+            # spotify pages followed artists with a cursor, the last artist id we got
+            "after": json_result["cursors"]["after"] if json_result.get("next") else None
+        }
 
-        for track in recently_played_tracks[:12]:
-            track_name = track['track']['name']
-            track_id = track['track']['id']
-            album_image = track['track']['album']['images'][0]['url'] if track['track']['album']['images'] else None
+        # every page we read anyway also fills in the following index
+        self.following_index().add_page(after, [artist["id"] for artist in page["items"]], page["after"])
+        return page
 
-            if track_id not in seen_tracks:
-                seen_tracks.add(track_id) 
-                
-                track_info = {
-                    "name": track_name,
-                    "id": track_id,
-                    "image": album_image
-                }
-                
-                track_info_list.append(track_info)
-        
-        return track_info_list
+    def iter_followed_artists(self, page_size=20, after=None):
+        # yields one page at a time so callers only pay for what they show
+        while True:
+            page = self.get_followed_artists_page(after, page_size)
+            if page is None:
+                return
+            yield page
+            if not page["after"]:
+                return
+            after = page["after"]
 
     def get_followed_artists(self):
-        url = "https://api.spotify.com/v1/me/following?type=artist&limit=5" 
-        headers = self.get_auth_header()
-        
-        result = get(url, headers=headers)
-        
-        if result.status_code != 200:
-            print(f"Error getting followed artists: {result.content}")
-            return None
-        
-        json_result = json.loads(result.content)
-        
-        return [{
-            "id": artist["id"],
-            "name": artist["name"],
-            "genres": artist["genres"],
-            "popularity": artist["popularity"],
-            "external_url": artist["external_urls"]["spotify"],
-            "image": artist["images"][0]["url"] if artist["images"] else None
-        } for artist in json_result["artists"]["items"]]
+        page = next(self.iter_followed_artists(page_size=5), None)
+        return page["items"] if page else None
         
     def get_artist_banner(self, artist_id):
-        url = f"https://open.spotify.com/artist/{artist_id}"
-        r = requests.get(url)
-
-        soup = BeautifulSoup(r.text, 'html.parser')
-
-        monthly_listeners_span = soup.find('span', class_='Ydwa1P5GkCggtLlSvphs')
+        snapshot = self.get_artist_page(artist_id)
 
-        if monthly_listeners_span:
-            monthly_listeners_text = monthly_listeners_span.text
-            monthly_listeners = monthly_listeners_text.split()[0] 
-            print(monthly_listeners)
+        if snapshot and snapshot.banner:
+            print(snapshot.banner)
+            return snapshot.banner
         else:
             print("Element not found")
             
     def today_biggest_hit(self):
-        url = 'https://open.spotify.com/'
+        return biggest_hits.get()
 
-        response = requests.get(url)
+    def fetch_today_biggest_hit(self):
+        url = f'{web_base}/'
 
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-        
-            span_elements = soup.find_all('span', class_='ListRowTitle__LineClamp-sc-1xe2if1-0')
+        response = self.http.get(url)
 
-            results = []
- 
-            for index, span in enumerate(span_elements):
-                if index >= 5:
-                    break
-                img_element = span.find_previous('img', class_='Image-sc-1u215sg-3')
-                
-                if img_element and 'src' in img_element.attrs:
-                    results.append({
-                        'src': img_element['src'],
-                        'text': span.get_text(strip=True)
-                    })
+        if response.status_code == 200:
+            results, _, _ = scraper.extract(response.content, HomePage())
             return results
         else:
             print(f"Failed to retrieve content. Status code: {response.status_code}")
         
     def follow_artist(self, artist_id):
         print(f"FOLLOW TOKEN {self.token}")
-        url = f"https://api.spotify.com/v1/me/following?type=artist&ids={artist_id}"
+        url = f"{api_base}/v1/me/following?type=artist&ids={artist_id}"
         headers = {
             "Authorization": "Bearer " + self.token,
             "Content-Type": "application/json"
         }
         
-        response = requests.put(url, headers=headers)
+        response = self.http.put(url, headers=headers)
 
         print(response.status_code)
         print(response.content)
 
         if response.status_code == 204:
             print("You followed the artist")
+            self.following_index().followed(artist_id)
+            self.invalidate_following()
             return True 
         else:
             print("Failed to follow artist")
             return False
         
     def unfollow_artist(self, artist_id):
-        url = f"https://api.spotify.com/v1/me/following?type=artist&ids={artist_id}"
+        url = f"{api_base}/v1/me/following?type=artist&ids={artist_id}"
         headers = {
             "Authorization": f"Bearer {self.token}",
             "Content-Type": "application/json"
         }
         
-        response = requests.delete(url, headers=headers)
+        response = self.http.delete(url, headers=headers)
         
         if response.status_code == 204:
             print("You unfollowed the artist")
+            self.following_index().unfollowed(artist_id)
+            self.invalidate_following()
             return True
         else:
             print("Failed to unfollow artist")
             return False
         
     def if_following_artist(self, artist_id):
-        url = f"https://api.spotify.com/v1/me/following/contains?type=artist&ids={artist_id}"
+        return self.if_following_artists([artist_id]).get(artist_id)
+
+    def if_following_artists(self, artist_ids):
+        # answered from the following index, spotify is only asked about ids it has not seen
+        return self.following_index().contains(self, artist_ids)
+
+    def get_following_contains(self, artist_ids):
+        # up to 50 ids in one call, same order as asked
+        url = f"{api_base}/v1/me/following/contains?type=artist&ids={','.join(artist_ids)}"
         headers = self.get_auth_header()
         
-        response = requests.get(url, headers=headers)
+        response = self.cached_get("following_contains", url, headers)
         
         if response.status_code == 200:
-            result = json.loads(response.content)
-            return result[0] if result else False
+            return json.loads(response.content)
         else:
-            print("Error in if_following_artist function")
+            print("Error in get_following_contains function")
         
     def get_artist_monthly_listeners(self, artist_id):
-        url = f'https://open.spotify.com/artist/{artist_id}'
+        snapshot = self.get_artist_page(artist_id)
+        return snapshot.monthly_listeners if snapshot else None
+    
+    def get_several_artists(self, artist_ids, fresh=False):
+        artists = {}
+        missing = []
 
-        response = requests.get(url)
-        html_content = response.text
+        for artist_id in artist_ids:
+            cached = None if fresh else artist_metadata_cache.get(artist_id)
+            if cached:
+                artists[artist_id] = cached
+            elif artist_id not in missing:
+                missing.append(artist_id)
 
-        soup = BeautifulSoup(html_content, 'html.parser')
+        # the endpoint takes at most 50 ids per call
+        for start in range(0, len(missing), 50):
+            ids = ",".join(missing[start:start + 50])
+            url = f"{api_base}/v1/artists?ids={ids}"
+            headers = self.get_auth_header()
 
-        span = soup.find('div', class_='fjP8GyQyM5IWQvTxWk6W')
+            result = self.http.get(url, headers=headers)
+
+            if result.status_code != 200:
+                print(f"Error getting artists: {result.content}")
+                continue
+
+            for artist in json.loads(result.content)["artists"]:
+                if artist:
+                    artist_metadata_cache.set(artist["id"], artist)
+                    artists[artist["id"]] = artist
+
+        return artists
 
-        if span:
-            monthly_listeners = span.text
-            return monthly_listeners
-        else:
-            return
-    
     def get_top_played_artists_data(self, top_played_artists):
+        top_played_artists = top_played_artists[:5]
+        artists = self.get_several_artists([artist_id for artist_id, _ in top_played_artists])
+
         top_artists = []
-        for top_artist, count in top_played_artists[:5]:
-            artist_info = self.search_for_artist(top_artist) 
-            artist_pfp = self.get_artist_image(artist_info) 
+        for artist_id, play_count in top_played_artists:
+            artist_pfp = self.get_artist_image(artists.get(artist_id))
 
             top_artists.append({
-                "artist": top_artist,
+                "artist": play_count["name"],
                 "image": artist_pfp,
-                "count": f"{count:,}"
+                "count": f"{play_count['count']:,}"
             })
             
         return top_artists
         
-    def get_saved_albums(self):
-        url = 'https://api.spotify.com/v1/me/albums'
+    def get_saved_albums_page(self, offset=0, limit=8):
+        url = f'{api_base}/v1/me/albums'
         headers = {
             'Authorization': f'Bearer {self.token}',
             'Content-Type': 'application/json'
         }
-        query = "?offset=0&limit=8"
+        query = f"?offset={offset}&limit={limit}"
         query_url = url + query
         albums = []
 
-        response = requests.get(query_url, headers=headers)
+        response = self.cached_get("saved_albums", query_url, headers)
         
         if response.status_code != 200:
             print(f"Error: {response.status_code} - {response.text}")
-            return []
+            return None
         
         data = response.json()
         items = data.get('items', [])
         
-        if not items:
-            return []
-        
         for item in items:
             album_name = item['album']['name']
-            album_image_url = item['album']['images'][0]['url'] if item['album']['images'] else None
+            album_image_url = pick_image(item['album']['images'], "album")
             albums.append({'name': album_name, 'image_url': album_image_url})
 
-        return albums
+        return {
+            "items": albums,
+            "next_offset": offset + len(items) if data.get('next') and items else None
+        }
+
+    def iter_saved_albums(self, page_size=20, offset=0):
+        while True:
+            page = self.get_saved_albums_page(offset, page_size)
+            if page is None:
+                return
+            yield page
+            if page["next_offset"] is None:
+                return
+            offset = page["next_offset"]
+
+    def get_saved_albums(self):
+        page = next(self.iter_saved_albums(page_size=8), None)
+        return page["items"] if page else []
         
-spotify_api = SpotifyApi()
+# the homepage hits are the same for everyone, so one background refresher serves every request
+biggest_hits = SharedDataset("today_biggest_hit", lambda: SpotifyApi().fetch_today_biggest_hit(), int(os.getenv("BIGGEST_HITS_INTERVAL", 900)))
+
+def get_spotify_api():
+    # a cheap per-request client built from this browser session's tokens
+    if "spotify_api" in g:
+        return g.spotify_api
+
+    g.spotify_api = None
+    session_id = session.get("session_id")
+    record = token_store.get(session_id) if session_id else None
+
+    if record:
+        spotify_api = SpotifyApi.from_record(record)
+
+        if spotify_api.token_expires_soon():
+            if spotify_api.refresh_token and spotify_api.refresh_access_token():
+                token_store.set(session_id, spotify_api.to_record())
+            else:
+                print("Failed to refresh token.")
+                token_store.delete(session_id)
+                return None
+
+        g.spotify_api = spotify_api
+    return g.spotify_api
 
 @app.route('/')
 def index():
-    auth_url = spotify_api.get_auth_url()
+    auth_url = SpotifyApi().get_auth_url()
     return render_template('main.html', auth_url=auth_url)
 
 @app.route('/logout')
 def logout():
-    spotify_api.token = None
+    session_id = session.pop("session_id", None)
+    if session_id:
+        token_store.delete(session_id)
     return redirect('/')
 
+@app.before_request
+def start_request():
+    if None in (token_store, history_store, image_cache, artist_profiles, page_version):
+        # served without going through create_app, e.g. `flask --app index run`
+        create_app()
+    g.started_at = time.perf_counter()
+    g.request_timings_token = request_timings.set([])
+
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings)
+
+@app.after_request
+def add_server_timing(response):
+    if "started_at" not in g:
+        return response
+
+    duration = time.perf_counter() - g.started_at
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("soundspace_request_duration_seconds", [("route", route)], duration)
+    metrics.inc("soundspace_requests_total", [("route", route), ("status", response.status_code)])
+
+    response.headers["Server-Timing"] = server_timing_header(request_timings.get() or [], duration)
+    return response
+
+@app.teardown_request
+def end_request(exc):
+    token = g.pop("request_timings_token", None)
+    if token is not None:
+        request_timings.reset(token)
+
+    token = g.pop("deadline_token", None)
+    if token is not None:
+        current_deadline.reset(token)
+
 # callback from auth_url
 # * by opening auth_url, spotify service will go to this route and will pass the authentication code as params
 # * 127.0.0.1:5000
@@ -478,10 +818,16 @@ def logout():
 def callback():
     try: 
         auth_code = request.args.get('code')
+        spotify_api = SpotifyApi()
         token = spotify_api.get_token(auth_code)
         
         if token:
             print("Token retrieved successfully.")
+            spotify_api.get_current_user_id()
+
+            session_id = os.urandom(24).hex()
+            token_store.set(session_id, spotify_api.to_record())
+            session["session_id"] = session_id
             return redirect('/home')
         else:
             print("Failed to retrieve token.")
@@ -489,76 +835,338 @@ def callback():
     except Exception as e:
         print(f"Error in callback route : {e}")
 
+def fetch_artist_details(spotify_api, artist_id, artist_data):
+    # everything here depends only on the artist id, so it can all run at once
+    songs = submit(spotify_api.get_songs_by_artist, artist_id)
+    following_artist = submit(spotify_api.if_following_artist, artist_id)
+    about = submit(spotify_api.get_artist_about, artist_id)
+    monthly_listeners = submit(spotify_api.get_artist_monthly_listeners, artist_data["id"])
+
+    artist = {
+        "id": spotify_api.get_artist_id(artist_data),
+        "name": spotify_api.get_artist_name(artist_data),
+        "image": spotify_api.get_artist_image(artist_data),
+        "about": panel_result(about, "about"),
+        "monthly_listeners": panel_result(monthly_listeners, "monthly_listeners")
+    }
+    
+    return panel_result(songs, "songs") or [], panel_result(following_artist, "following_artist"), artist
+
+# how many followed artists a user's warm up covers, on top of the artists they played lately
+ARTIST_WARM_LIMIT = int(os.getenv("ARTIST_WARM_LIMIT", 50))
+
+def load_artist_profiles(spotify_api, artist_ids, fresh=False):
+    # runs on profile_warmer, never on a request: one several-artists call per batch, then top tracks and the page per artist
+    # a refresh (fresh) goes past our caches, otherwise a stale profile would be stored again with day old data
+    artists = spotify_api.get_several_artists(artist_ids, fresh)
+
+    profiles = {}
+    for artist_id in artist_ids:
+        artist_data = artists.get(artist_id)
+        if artist_data is None:
+            continue
+
+        songs = spotify_api.get_songs_by_artist(artist_id, fresh)
+        snapshot = spotify_api.get_artist_page(artist_id, fresh)
+        # a half built profile would hide what is missing until it goes stale, leave it for the next refresh
+        if songs is None or snapshot is None:
+            continue
+
+        num_of_followers = artist_data["followers"]["total"] if artist_data.get("followers") else None
+        profiles[artist_id] = {
+            "id": artist_id,
+            "name": artist_data["name"],
+            "images": artist_data["images"],
+            "image": spotify_api.get_artist_image(artist_data),
+            "followers": format(num_of_followers, ",") if num_of_followers is not None else None,
+            "songs": songs,
+            "about": snapshot.about,
+            "monthly_listeners": snapshot.monthly_listeners,
+            "banner": snapshot.banner
+        }
+    return profiles
+
+def artist_ids_to_warm(spotify_api):
+    artist_ids = []
+    for page in spotify_api.iter_followed_artists(page_size=50):
+        artist_ids.extend(artist["id"] for artist in page["items"])
+        if len(artist_ids) >= ARTIST_WARM_LIMIT:
+            break
+    artist_ids = artist_ids[:ARTIST_WARM_LIMIT]
+
+    snapshot = spotify_api.get_recently_played_snapshot()
+    if snapshot:
+        artist_ids.extend(snapshot.artist_play_count)
+    return list(dict.fromkeys(artist_ids))
+
+def stored_artist_profile(spotify_api, get_artist, current_artist_id):
+    # the artist view reads from the profile store, a stale profile is still shown and refreshed behind it
+    if get_artist:
+        profile = artist_profiles.find(get_artist)
+    elif current_artist_id:
+        profile = artist_profiles.get(current_artist_id)
+    else:
+        return None
+
+    if profile and artist_profiles.is_stale(profile):
+        profile_warmer.refresh_in_background(spotify_api, [profile["id"]])
+    return profile
+
+# flush the page shell right away and send each panel as soon as its data is in
+HOME_STREAMING = os.getenv("HOME_STREAMING", "1") == "1"
+# a home page whose data is all in within this is sent whole, with an ETag, instead of streamed
+HOME_STREAM_AFTER = float(os.getenv("HOME_STREAM_AFTER", 0.02))
+STREAM_MARKER = "<!-- panels -->"
+
+# results a streamed panel waits for before it is rendered
+HOME_PANELS = {
+    "followed_artists": ("followed_artists",),
+    "albums": ("albums",),
+    "recently_played": ("recently_played",),
+    "artist_header": ("artist", "following_artist"),
+    "artist_songs": ("songs",),
+    "artist_about": ("artist", "about", "monthly_listeners"),
+}
+
+def as_they_finish(pending):
+    # yields (name, future) in completion order, the caller may add futures to pending while iterating
+    while pending:
+        done, _ = wait(pending, timeout=g.deadline.remaining(), return_when=FIRST_COMPLETED)
+        # past the deadline whatever is left goes out too, panel_result marks it degraded
+        for future in done or list(pending):
+            yield pending.pop(future), future
+
+def home_panel_html(name, results, artist_view):
+    macro = get_template_attribute('home_panels.html', name)
+
+    if name == "followed_artists":
+        return macro(results["followed_artists"], g.degraded, 4 if artist_view else None)
+    elif name == "albums":
+        return macro(results["albums"] or [], g.degraded)
+    elif name == "recently_played":
+        return macro(results["recently_played"] or [], g.degraded)
+    elif name == "artist_header":
+        return macro(results["artist"] or {}, results["artist_id"], results["artist_data"], results["following_artist"])
+    elif name == "artist_songs":
+        return macro(results["songs"] or [], g.degraded)
+    else:
+        return macro({**(results["artist"] or {}), "about": results["about"], "monthly_listeners": results["monthly_listeners"]}, g.degraded)
+
+def render_home_panel(name, results, artist_view):
+    # keyed by the panel's own data, so it is only rendered again once that data changes
+    inputs = {need: results[need] for need in HOME_PANELS[name]}
+    if name == "artist_header":
+        inputs.update(artist_id=results["artist_id"], artist_data=results["artist_data"])
+    key = ("home_panel", name, fingerprint(inputs, artist_view, g.degraded))
+    html = fragment_cache.render(key, lambda: home_panel_html(name, results, artist_view))
+
+    return f'<template id="panel-{name}-content">{html}</template><script>fillPanel("{name}")</script>\n'
+
+def render_home_shell(artist_view):
+    key = ("home_shell", page_version, artist_view, fingerprint(g.degraded))
+    return fragment_cache.render(key, lambda: render_template('home.html', streaming=True, artist_view=artist_view, degraded=g.degraded)).split(STREAM_MARKER)
+
+def stream_home(spotify_api, get_artist, current_artist_name, current_artist_id):
+    # only what this view shows is fetched, and all of it starts before the shell is rendered
+    pending = {submit(spotify_api.get_followed_artists): "followed_artists"}
+    results = {}
+    profile = stored_artist_profile(spotify_api, get_artist, current_artist_id)
+    artist_search = submit(spotify_api.search_for_artist, get_artist) if get_artist and not profile else None
+    artist_data = None
+
+    if profile or current_artist_id:
+        artist_view = True
+    elif artist_search:
+        # a search that finds nothing shows the home view, same as the non streamed page, so the shell waits for it
+        artist_data = panel_result(artist_search, "artist")
+        artist_view = artist_data is not None
+    else:
+        artist_view = False
+
+    def take(name, result):
+        if name == "artist":
+            artist_data = result
+            artist_id = artist_data["id"] if get_artist and artist_data else current_artist_id
+            if artist_data is None and artist_id:
+                # same as the non streamed page, the link tells us enough to show the rest of the artist
+                artist_data = {"id": artist_id, "name": current_artist_name, "images": []}
+
+            results["artist_data"] = result if get_artist else None
+            results["artist_id"] = artist_id
+            if artist_data is None:
+                result = None
+                results.update(songs=[], following_artist=None, about=None, monthly_listeners=None)
+            else:
+                result = {
+                    "id": spotify_api.get_artist_id(artist_data),
+                    "name": spotify_api.get_artist_name(artist_data),
+                    "image": spotify_api.get_artist_image(artist_data)
+                }
+                pending[submit(spotify_api.get_songs_by_artist, artist_id)] = "songs"
+                pending[submit(spotify_api.if_following_artist, artist_id)] = "following_artist"
+                pending[submit(spotify_api.get_artist_about, artist_id)] = "about"
+                pending[submit(spotify_api.get_artist_monthly_listeners, artist_data["id"])] = "monthly_listeners"
+                # built live this time, the next view of this artist reads it from the store
+                profile_warmer.refresh_in_background(spotify_api, [artist_id])
+
+        results[name] = result
+
+    if profile:
+        # a stored profile leaves only the follow status to ask about
+        results.update(
+            artist={"id": profile["id"], "name": profile["name"], "image": profile["image"]},
+            artist_data=profile if get_artist else None,
+            artist_id=profile["id"],
+            songs=profile["songs"],
+            about=profile["about"],
+            monthly_listeners=profile["monthly_listeners"]
+        )
+        pending[submit(spotify_api.if_following_artist, profile["id"])] = "following_artist"
+    elif artist_data is not None:
+        take("artist", artist_data)
+    elif artist_view:
+        pending[artist_search or submit(spotify_api.search_for_artist, current_artist_name)] = "artist"
+    else:
+        pending[submit(spotify_api.get_saved_albums)] = "albums"
+        pending[submit(spotify_api.getRecentlyPlayedTracks)] = "recently_played"
+
+    rendered = set()
+
+    def ready_panels():
+        for panel, needs in HOME_PANELS.items():
+            if panel not in rendered and all(need in results for need in needs):
+                rendered.add(panel)
+                yield panel
+
+    def collect_panels():
+        # yields each panel name as soon as everything it needs is in results
+        for name, future in as_they_finish(pending):
+            take(name, panel_result(future, name))
+            yield from ready_panels()
+
+    # take in whatever is already there, a search answered from cache only now submits the artist details
+    panels = list(ready_panels())
+    while pending:
+        done, not_done = wait(pending, timeout=HOME_STREAM_AFTER)
+        for future in done:
+            name = pending.pop(future)
+            take(name, panel_result(future, name))
+        panels.extend(ready_panels())
+        if not_done:
+            break
+
+    if not pending:
+        # everything came out of caches (a refresh, back navigation), nothing to gain from streaming
+        # sent whole instead, so the page can carry an ETag and a repeat visit is a 304
+        def render():
+            shell, tail = render_home_shell(artist_view)
+            return shell + "".join(render_home_panel(panel, results, artist_view) for panel in panels) + tail
+
+        return page_response(spotify_api, "home", [artist_view, results, g.degraded], render)
+
+    shell, tail = render_home_shell(artist_view)
+
+    def generate():
+        yield shell
+        for panel in panels:
+            yield render_home_panel(panel, results, artist_view)
+        for panel in collect_panels():
+            yield render_home_panel(panel, results, artist_view)
+        yield tail
+
+    # Server-Timing on a streamed page only covers the shell, the panels are sent after the headers
+    return Response(stream_with_context(generate()), mimetype="text/html", headers={"X-Accel-Buffering": "no"})
+
 @app.route('/home', methods=['GET', 'POST'])
 def home():
-    if spotify_api.token:
-        popular_artist = spotify_api.today_biggest_hit()
-        followed_artists = spotify_api.get_followed_artists()
-        top_recently_played_songs = spotify_api.getTop5Tracks()
-        recentlyPlayedTracks = spotify_api.getRecentlyPlayedTracks()
-        albums = spotify_api.get_saved_albums()
-  
+    spotify_api = get_spotify_api()
+    if spotify_api:
+        start_deadline(HOME_DEADLINE)
+        profile_warmer.warm(spotify_api)
+
         get_artist = request.form.get('artist_name') 
-        artist_data = spotify_api.search_for_artist(get_artist)
-        
         current_artist_name = request.args.get('artist_name')
         current_artist_id = request.args.get('artist_id')
+
+        if HOME_STREAMING:
+            return stream_home(spotify_api, get_artist, current_artist_name, current_artist_id)
         
-        current_artist_data = spotify_api.search_for_artist(current_artist_name)
+        # start every independent call first, the artist details wait on the searches below
+        popular_artist = submit(spotify_api.today_biggest_hit)
+        followed_artists = submit(spotify_api.get_followed_artists)
+        top_recently_played_songs = submit(spotify_api.getTop5Tracks)
+        recentlyPlayedTracks = submit(spotify_api.getRecentlyPlayedTracks)
+        albums = submit(spotify_api.get_saved_albums)
+        profile = stored_artist_profile(spotify_api, get_artist, current_artist_id)
 
         songs = []
         artist = {}
         artist_id = None
+        artist_data = None
         
         following_artist = None
         
-        if current_artist_id and artist_data is None:
-            artist_id = current_artist_id
-            
-            songs = spotify_api.get_songs_by_artist(artist_id)
-            following_artist = spotify_api.if_following_artist(artist_id)
-            
-            artist = {
-                "id": spotify_api.get_artist_id(current_artist_data),
-                "name": spotify_api.get_artist_name(current_artist_data),
-                "image": spotify_api.get_artist_image(current_artist_data),
-                "about": spotify_api.get_artist_about(artist_id),
-                "monthly_listeners": spotify_api.get_artist_monthly_listeners(current_artist_data["id"])
-            }
-        elif artist_data is not None:
-            artist_id = artist_data["id"]
-        
-        if artist_data is not None:
-            songs = spotify_api.get_songs_by_artist(artist_id)
-            following_artist = spotify_api.if_following_artist(artist_id)
-            
-            artist = {
-                "id": spotify_api.get_artist_id(artist_data),
-                "name": spotify_api.get_artist_name(artist_data),
-                "image": spotify_api.get_artist_image(artist_data),
-                "about": spotify_api.get_artist_about(artist_id),
-                "monthly_listeners": spotify_api.get_artist_monthly_listeners(artist_data["id"])
-            }
-        
-        return render_template('home.html',artist_data=artist_data, artist_id=artist_id, artist=artist, songs=songs, followed_artists=followed_artists, following_artist=following_artist, popular_artist=popular_artist, top_recently_played_songs=top_recently_played_songs, recentlyPlayedTracks=recentlyPlayedTracks, albums=albums)
+        if profile:
+            artist_id = profile["id"]
+            artist_data = profile if get_artist else None
+            following_artist = panel_result(submit(spotify_api.if_following_artist, artist_id), "following_artist")
+            songs = profile["songs"]
+            artist = {key: profile[key] for key in ("id", "name", "image", "about", "monthly_listeners")}
+        else:
+            artist_search = submit(spotify_api.search_for_artist, get_artist)
+            current_artist_search = submit(spotify_api.search_for_artist, current_artist_name)
+            artist_data = panel_result(artist_search, "artist")
+
+            if artist_data is not None:
+                artist_id = artist_data["id"]
+                songs, following_artist, artist = fetch_artist_details(spotify_api, artist_id, artist_data)
+            elif current_artist_id:
+                artist_id = current_artist_id
+                # without the search result we still know enough from the link to show the rest of the artist
+                current_artist_data = panel_result(current_artist_search, "artist") or {"id": artist_id, "name": current_artist_name, "images": []}
+                songs, following_artist, artist = fetch_artist_details(spotify_api, artist_id, current_artist_data)
+
+            if artist_id:
+                # built live this time, the next view of this artist reads it from the store
+                profile_warmer.refresh_in_background(spotify_api, [artist_id])
+        
+        context = dict(artist_view=bool(artist_id or artist.get("name")), artist_data=artist_data, artist_id=artist_id, artist=artist, songs=songs, followed_artists=panel_result(followed_artists, "followed_artists"), following_artist=following_artist, popular_artist=panel_result(popular_artist, "popular_artist"), top_recently_played_songs=panel_result(top_recently_played_songs, "top_recently_played_songs"), recentlyPlayedTracks=panel_result(recentlyPlayedTracks, "recently_played") or [], albums=panel_result(albums, "albums") or [], degraded=g.degraded)
+        return page_response(spotify_api, "home", context, lambda: render_template('home.html', **context))
     return redirect('/')
 
 @app.route('/wrapped')
 def wrapped():
-    if spotify_api.token:
-        top_recently_played_songs = spotify_api.getTop5Tracks()
+    spotify_api = get_spotify_api()
+    if spotify_api:
+        start_deadline(WRAPPED_DEADLINE)
+
+        # wrapped reads from our own listening history, spotify is only asked for plays we have not stored yet
+        # if spotify is slow or down we still show what we have stored
+        panel_result(submit(history_store.sync, spotify_api), "history_sync")
+        user_id = spotify_api.get_user_key()
+
+        top_recently_played_songs = history_store.top_tracks(user_id)
+        artist_play_count = history_store.artist_play_count(user_id)
 
-        artist_play_count = spotify_api.get_recently_played_tracks()
+        if not top_recently_played_songs:
+            top_recently_played_songs = panel_result(submit(spotify_api.getTop5Tracks), "top_recently_played_songs")
+            artist_play_count = panel_result(submit(spotify_api.get_recently_played_tracks), "top_artists") or {}
         
-        top_played_artists = sorted(artist_play_count.items(), key=lambda x: x[1], reverse=True)[:10]
-        spotify_wrapped = spotify_api.get_top_played_artists_data(top_played_artists)
+        top_played_artists = sorted(artist_play_count.items(), key=lambda x: x[1]["count"], reverse=True)[:10]
+        spotify_wrapped = panel_result(submit(spotify_api.get_top_played_artists_data, top_played_artists), "top_artists")
 
-        return render_template('wrapped.html', spotify_wrapped=spotify_wrapped, top_recently_played_songs=top_recently_played_songs)
+        if spotify_wrapped is None:
+            # names and counts are ours, only the images had to come from spotify
+            spotify_wrapped = [{"artist": play_count["name"], "image": None, "count": f"{play_count['count']:,}"} for _, play_count in top_played_artists[:5]]
+
+        context = dict(spotify_wrapped=spotify_wrapped, top_recently_played_songs=top_recently_played_songs, degraded=g.degraded)
+        return page_response(spotify_api, "wrapped", context, lambda: render_template('wrapped.html', **context))
     return redirect('/')
 
 @app.route('/followArtist', methods=['POST'])
 def followArtist():
-    if spotify_api.token:
+    spotify_api = get_spotify_api()
+    if spotify_api:
         artist_id = request.form.get('artist_id')
         artist_name = request.form.get('artist_name')
 
@@ -571,7 +1179,8 @@ def followArtist():
 
 @app.route('/unfollowArtist', methods=['POST'])
 def unfollowArtist():
-    if spotify_api.token:
+    spotify_api = get_spotify_api()
+    if spotify_api:
         artist_id = request.form.get('artist_id')
         artist_name = request.form.get('artist_name')
         
@@ -580,6 +1189,150 @@ def unfollowArtist():
             
         return redirect(url_for('home', artist_id=artist_id, artist_name=artist_name))
 
+# pages for the infinite scroll panels on home.html
+PAGE_SIZE_LIMIT = 50
+
+@app.route('/api/albums')
+def albums_page():
+    spotify_api = get_spotify_api()
+    if not spotify_api:
+        return {"error": "Not logged in"}, 401
+
+    # spotify answers 400 to anything outside these, which would come back as a 502
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(1, min(request.args.get('limit', 8, type=int), PAGE_SIZE_LIMIT))
+
+    page = next(spotify_api.iter_saved_albums(page_size=limit, offset=offset), None)
+    if page is None:
+        return {"error": "Could not load albums"}, 502
+    return page
+
+@app.route('/api/followed-artists')
+def followed_artists_page():
+    spotify_api = get_spotify_api()
+    if not spotify_api:
+        return {"error": "Not logged in"}, 401
+
+    after = request.args.get('after')
+    limit = max(1, min(request.args.get('limit', 5, type=int), PAGE_SIZE_LIMIT))
+
+    page = next(spotify_api.iter_followed_artists(page_size=limit, after=after), None)
+    if page is None:
+        return {"error": "Could not load followed artists"}, 502
+    return page
+
+# follow state changes in place from home.html, the form routes above stay as the no-javascript fallback
+@app.route('/api/following/<artist_id>', methods=['POST', 'DELETE'])
+def following_api(artist_id):
+    spotify_api = get_spotify_api()
+    if not spotify_api:
+        return {"error": "Not logged in"}, 401
+
+    follow = request.method == 'POST'
+    changed = spotify_api.follow_artist(artist_id) if follow else spotify_api.unfollow_artist(artist_id)
+    if not changed:
+        return {"error": "Could not follow artist" if follow else "Could not unfollow artist", "artist_id": artist_id, "following": not follow}, 502
+    return {"artist_id": artist_id, "following": follow}
+
+@app.route('/metrics')
+def prometheus_metrics():
+    lines = [metrics.render()]
+
+    lines.append("# HELP soundspace_response_cache_events_total Response cache hits, misses, revalidations, evictions and invalidations")
+    lines.append("# TYPE soundspace_response_cache_events_total counter")
+    for endpoint, counters in response_cache.stats()["endpoints"].items():
+        for event, value in counters.items():
+            lines.append(f'soundspace_response_cache_events_total{{endpoint="{endpoint}",event="{event}"}} {value}')
+
+    lines.append("# HELP soundspace_response_cache_entries Entries currently held in the response cache")
+    lines.append("# TYPE soundspace_response_cache_entries gauge")
+    lines.append(f"soundspace_response_cache_entries {response_cache.stats()['entries']}")
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route('/cache/stats')
+def cache_stats():
+    return {**response_cache.stats(), "fragments": fragment_cache.stats()}
+
+@app.route('/scrape/stats')
+def scrape_stats():
+    return scraper.report()
+
+@app.route('/artists/stats')
+def artist_profile_stats():
+    return {**artist_profiles.stats(), "warmer": profile_warmer.stats()}
+
+# fingerprinted files never change under the same name, so browsers can keep them for a year without asking
+asset_manifest = AssetManifest()
+ASSET_MAX_AGE = 31536000
+
+@app.template_global()
+def asset_url(path):
+    hashed = asset_manifest.get(path)
+    if hashed:
+        return url_for('asset', filename=hashed)
+    # `python assets.py` has not been run, serve the file as it is
+    return url_for('static', filename=path)
+
+app.jinja_env.globals["thumb_widths"] = THUMB_WIDTHS
+
+@app.template_global()
+def thumb_url(url, kind):
+    # album and artist art goes through /img so it is resized to the box it is shown in and cached here
+    if not url:
+        return url
+    return url_for('image_proxy', src=url, w=THUMB_WIDTHS[kind])
+
+def fetch_image(url):
+    # every image has its own url, they all go under one endpoint label
+    response = http.get(url, endpoint="/image/{id}")
+    if response.status_code != 200:
+        print(f"Could not fetch image {url}: {response.status_code}")
+        return None
+    return response.content
+
+@app.route('/img')
+def image_proxy():
+    src = request.args.get('src', '')
+    parts = urlsplit(src)
+    if parts.scheme not in ('http', 'https') or parts.hostname not in IMAGE_PROXY_HOSTS:
+        return {"error": "Image host not allowed"}, 400
+
+    width = thumbnail_width(request.args.get('w', type=int))
+    fmt = output_format(request.accept_mimetypes)
+    try:
+        thumbnail = image_cache.thumbnail(src, width, fmt, lambda: fetch_image(src))
+    except Exception as e:
+        print(f"Image proxy failed for {src}: {e}")
+        thumbnail = None
+    if thumbnail is None:
+        # the page still gets its picture, just not a resized one
+        return redirect(src)
+
+    # the same src and width always give the same picture, spotify never reuses an image url
+    try:
+        response = send_file(thumbnail.path, mimetype=thumbnail.content_type, etag=thumbnail.digest, max_age=ASSET_MAX_AGE, conditional=True)
+    except FileNotFoundError:
+        # evicted by another request in the meantime
+        return redirect(src)
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    response.vary.add("Accept")
+    return response
+
+@app.route('/img/stats')
+def image_stats():
+    return image_cache.stats()
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    send_name, encoding = asset_manifest.precompressed(filename, request.accept_encodings)
+    response = send_from_directory(asset_manifest.directory, send_name, mimetype=mimetypes.guess_type(filename)[0], max_age=ASSET_MAX_AGE)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    return response
+
 if __name__ == '__main__':
-    app.run(port=port, debug=True)
+    create_app().run(port=port, debug=True)
     
\ No newline at end of file
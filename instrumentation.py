@@ -0,0 +1,135 @@
+import contextvars
+import re
+import threading
+from urllib.parse import urlsplit
+
+# upstream calls made while handling the current flask request, see start_request in index.py
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ID_SEGMENT_RE = re.compile(r"/(artists?|image)/[^/?]+")
+
+
+def endpoint_name(url):
+    # keeps label cardinality bounded, /v1/artists/<id>/top-tracks -> /v1/artists/{id}/top-tracks, /image/<id> -> /image/{id}
+    return ID_SEGMENT_RE.sub(r"/\1/{id}", urlsplit(url).path) or "/"
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            key = (name, tuple(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            key = (name, tuple(labels))
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def render(self):
+        # prometheus text exposition format
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{key}="{str(value)}"' for key, value in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters} | {name for name, _ in self.histograms})
+            for name in names:
+                kind, text = self.help.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{name}{label_text(labels)} {value}")
+
+                for (histogram_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{label_text(labels, [('le', bound)])} {bucket_count}")
+                    lines.append(f"{name}_bucket{label_text(labels, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{label_text(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("soundspace_upstream_requests_total", "counter", "Calls to Spotify, including ones answered from our cache")
+metrics.describe("soundspace_upstream_request_duration_seconds", "histogram", "Time spent on calls to Spotify")
+metrics.describe("soundspace_upstream_response_bytes_total", "counter", "Bytes received from Spotify")
+metrics.describe("soundspace_scrape_parse_duration_seconds", "histogram", "Time spent extracting data from scraped pages")
+metrics.describe("soundspace_request_duration_seconds", "histogram", "Time spent handling requests to this app")
+metrics.describe("soundspace_requests_total", "counter", "Requests handled by this app")
+metrics.describe("soundspace_degraded_panels_total", "counter", "Panels rendered as placeholders because their data missed the deadline or failed")
+
+
+def add_request_timing(name, duration, description):
+    timings = request_timings.get()
+    if timings is not None:
+        timings.append({"name": name, "duration": duration, "description": description})
+
+
+def record_upstream(method, url, status, size, duration, cache="none", endpoint=None):
+    # endpoint is for callers whose urls carry ids endpoint_name does not know about
+    endpoint = endpoint or endpoint_name(url)
+    host = urlsplit(url).netloc
+
+    metrics.inc("soundspace_upstream_requests_total", [("host", host), ("endpoint", endpoint), ("method", method), ("status", status), ("cache", cache)])
+    metrics.observe("soundspace_upstream_request_duration_seconds", [("host", host), ("endpoint", endpoint), ("cache", cache)], duration)
+    if size:
+        metrics.inc("soundspace_upstream_response_bytes_total", [("host", host), ("endpoint", endpoint)], size)
+
+    add_request_timing(endpoint, duration, f"{method} {endpoint} {status} {cache}")
+
+
+def record_parse(page, backend, duration):
+    metrics.observe("soundspace_scrape_parse_duration_seconds", [("page", page), ("backend", backend)], duration)
+    add_request_timing(f"parse-{page}", duration, f"parse {page} page with {backend}")
+
+
+def server_timing_header(timings, total=None):
+    # one entry per endpoint, durations summed, so the header stays short even for a dozen calls
+    grouped = {}
+    for timing in timings:
+        name = re.sub(r"[^A-Za-z0-9_-]+", "-", timing["name"]).strip("-") or "root"
+        entry = grouped.setdefault(name, {"duration": 0.0, "count": 0, "description": timing["description"]})
+        entry["duration"] += timing["duration"]
+        entry["count"] += 1
+
+    parts = []
+    for name, entry in grouped.items():
+        description = entry["description"] if entry["count"] == 1 else f"{entry['description']} x{entry['count']}"
+        parts.append(f'{name};dur={entry["duration"] * 1000:.1f};desc="{description}"')
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
@@ -0,0 +1,352 @@
+"""Load test: how the app scales under a real WSGI server across worker, thread and user counts.
+
+    python load_benchmark.py --workers 1,2,4 --threads 1,8 --users 1,16,64 --duration 15
+    python load_benchmark.py --server waitress --threads 4,16 --json load_output.json
+
+Every configuration gets a fresh server process (gunicorn, or waitress when gunicorn is not
+installed) in front of index:create_app(), pointed at stub_server.py running in its own process.
+Simulated users log in once and then request /home, an artist view and /wrapped in turn until
+--duration runs out. Reports throughput, latency percentiles per route, upstream calls per
+request and the CPU and peak memory of the whole server process tree.
+
+CPU is in percent of one core. A worker whose CPU stays near 100% no matter how many threads it
+gets is held by the GIL (mostly template rendering and page parsing), more processes are what
+helps there. gunicorn and psutil are in requirements-dev.txt (waitress works too), without a
+production server the sweep stops. --server werkzeug measures the dev server once, only as a point
+of comparison. The users are threads in this process, so keep it on a machine (or cores) of its own
+when the numbers matter.
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmark import percentile
+
+HAS_GUNICORN = importlib.util.find_spec("gunicorn") is not None
+HAS_WAITRESS = importlib.util.find_spec("waitress") is not None
+HAS_PSUTIL = importlib.util.find_spec("psutil") is not None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ROUTES = ["home", "artist", "wrapped"]
+# how often the server's cpu and memory are sampled
+SAMPLE_INTERVAL = 0.25
+
+WERKZEUG_SERVER = """
+import sys
+from werkzeug.serving import run_simple
+import index
+run_simple("127.0.0.1", int(sys.argv[1]), index.create_app(), threaded=True)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout=30):
+    started = time.time()
+    while time.time() - started < timeout:
+        if process.poll() is not None:
+            raise SystemExit(f"{url} exited with {process.returncode} before it came up")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise SystemExit(f"{url} did not come up within {timeout}s")
+
+
+def pick_server(name):
+    installed = {"gunicorn": HAS_GUNICORN, "waitress": HAS_WAITRESS, "werkzeug": True}
+    if name == "auto":
+        name = "gunicorn" if HAS_GUNICORN else "waitress" if HAS_WAITRESS else None
+    if name is None or not installed[name]:
+        # the dev server cannot run the worker and thread sweep, a silent fallback would report a single meaningless row
+        missing = f"{name} is not installed" if name else "Neither gunicorn nor waitress is installed"
+        raise SystemExit(f"{missing}, run pip install -r requirements-dev.txt (or pass --server werkzeug for a single dev server run)")
+    return name
+
+
+def server_configs(server, workers, threads):
+    # (workers, threads) pairs the server can actually run, None threads means one thread per request
+    if server == "gunicorn":
+        return list(itertools.product(workers, threads))
+    if server == "waitress":
+        if any(count != 1 for count in workers):
+            print("waitress runs a single process, only --workers 1 is measured")
+        return [(1, count) for count in threads]
+    print("the werkzeug dev server runs one process with a thread per request, --workers and --threads are ignored")
+    return [(1, None)]
+
+
+def server_command(server, port, workers, threads):
+    if server == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "--workers", str(workers), "--threads", str(threads),
+                "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "index:create_app()"]
+    if server == "waitress":
+        return [sys.executable, "-m", "waitress", f"--threads={threads}", f"--listen=127.0.0.1:{port}", "--call", "index:create_app"]
+    return [sys.executable, "-c", WERKZEUG_SERVER, str(port)]
+
+
+def app_env(stub_url, workdir):
+    env = dict(os.environ)
+    env.update({
+        "SPOTIFY_API_BASE": stub_url,
+        "SPOTIFY_WEB_BASE": stub_url,
+        "SPOTIFY_ACCOUNTS_BASE": stub_url,
+        "HISTORY_DB": os.path.join(workdir, "history.db"),
+        "ARTIST_PROFILE_DB": os.path.join(workdir, "artist_profiles.db"),
+        "IMAGE_CACHE_DIR": os.path.join(workdir, "image_cache"),
+        # every worker has to see the sessions the others created
+        "TOKEN_STORE": f"sqlite:///{os.path.join(workdir, 'tokens.db')}",
+        "SECRET_KEY": "load-benchmark",
+    })
+    return env
+
+
+def process_tree_usage(pid):
+    # (cpu seconds, rss bytes) summed over pid and everything it forked, e.g. gunicorn's workers
+    if HAS_PSUTIL:
+        import psutil
+        try:
+            root = psutil.Process(pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return 0, 0
+        cpu = rss = 0
+        for process in processes:
+            try:
+                times = process.cpu_times()
+                cpu += times.user + times.system
+                rss += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return cpu, rss
+
+    # linux without psutil, straight from /proc
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                parents[int(entry)] = (int(fields[1]), fields)
+            except OSError:
+                pass
+
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, (parent, _) in parents.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                changed = True
+
+    ticks = os.sysconf("SC_CLK_TCK")
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    cpu = rss = 0
+    for process in tree:
+        if process in parents:
+            fields = parents[process][1]
+            # utime and stime are fields 14 and 15 of stat, rss (in pages) is 24
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            rss += int(fields[21]) * page_size
+    return cpu, rss
+
+
+class UsageSampler:
+    # cpu used and the highest rss seen between start() and stop()
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.peak_rss = max(self.peak_rss, process_tree_usage(self.pid)[1])
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.started_cpu, self.peak_rss = process_tree_usage(self.pid)
+        self.thread = threading.Thread(target=self.run, name="usage-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        cpu, rss = process_tree_usage(self.pid)
+        self.stopped.set()
+        self.thread.join()
+        elapsed = time.perf_counter() - self.started_at
+        return {
+            "cpu_percent": round((cpu - self.started_cpu) / elapsed * 100, 1),
+            "peak_rss_mb": round(max(self.peak_rss, rss) / 1024 / 1024, 1),
+        }
+
+
+def simulated_user(base_url, paths, offset, measure_from, stop_at, samples):
+    session = requests.Session()
+    login = session.get(f"{base_url}/callback?code=load-{offset}", allow_redirects=False)
+    if login.status_code != 302:
+        samples.append((None, 0, login.status_code, False))
+        return
+
+    routes = list(paths)
+    for count in itertools.count(offset):
+        route = routes[count % len(routes)]
+        started = time.perf_counter()
+        if started >= stop_at:
+            return
+        try:
+            # the whole body, streamed pages included
+            status = session.get(f"{base_url}{paths[route]}", timeout=30).status_code
+        except requests.RequestException:
+            status = 0
+        finished = time.perf_counter()
+        if started >= measure_from and finished <= stop_at:
+            samples.append((route, (finished - started) * 1000, status, 200 <= status < 400))
+
+
+def upstream_calls(stub_url):
+    return sum(count for name, count in requests.get(f"{stub_url}/__stats").json().items() if not name.startswith("injected"))
+
+
+def run_config(server, workers, threads, users, paths, stub_url, args):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    workdir = tempfile.mkdtemp(prefix="soundspace-load-")
+    process = subprocess.Popen(server_command(server, port, workers, threads), cwd=ROOT, env=app_env(stub_url, workdir),
+                               stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        wait_until_up(f"{base_url}/", process)
+
+        samples = []
+        sampler = UsageSampler(process.pid)
+        measure_from = time.perf_counter() + args.warmup
+        stop_at = measure_from + args.duration
+        user_threads = [
+            threading.Thread(target=simulated_user, args=(base_url, paths, offset, measure_from, stop_at, samples), daemon=True)
+            for offset in range(users)
+        ]
+        for thread in user_threads:
+            thread.start()
+
+        # warmup fills the app's caches, only what happens after it counts
+        time.sleep(max(0, measure_from - time.perf_counter()))
+        calls_before = upstream_calls(stub_url)
+        sampler.start()
+        for thread in user_threads:
+            thread.join()
+        usage = sampler.stop()
+        calls = upstream_calls(stub_url) - calls_before
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    result = {
+        "server": server,
+        "workers": workers,
+        "threads": threads,
+        "users": users,
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if not sample[3]),
+        "rps": round(len(samples) / args.duration, 1),
+        "upstream_calls_per_request": round(calls / len(samples), 2) if samples else None,
+        **usage,
+        "routes": {},
+    }
+    for route in [None] + list(paths):
+        latencies = [sample[1] for sample in samples if route is None or sample[0] == route]
+        if not latencies:
+            continue
+        result["routes"][route or "all"] = {
+            "requests": len(latencies),
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+        }
+    return result
+
+
+def print_results(results, routes):
+    header = f"{'server':<10} {'workers':>7} {'threads':>7} {'users':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>6} {'calls':>6} {'cpu%':>6} {'rss MB':>7}"
+    header += "".join(f" {route + ' p95':>12}" for route in routes)
+    print(header)
+    for result in results:
+        overall = result["routes"].get("all", {})
+        line = f"{result['server']:<10} {result['workers']:>7} {result['threads'] or '-':>7} {result['users']:>5} {result['rps']:>8}"
+        line += f" {overall.get('p50_ms', '-'):>8} {overall.get('p95_ms', '-'):>8} {overall.get('p99_ms', '-'):>8}"
+        line += f" {result['errors']:>6} {result['upstream_calls_per_request'] or '-':>6} {result['cpu_percent']:>6} {result['peak_rss_mb']:>7}"
+        line += "".join(f" {result['routes'].get(route, {}).get('p95_ms', '-'):>12}" for route in routes)
+        print(line)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", default="auto", choices=["auto", "gunicorn", "waitress", "werkzeug"])
+    parser.add_argument("--workers", type=int_list, default=[1, 2], help="comma separated process counts")
+    parser.add_argument("--threads", type=int_list, default=[1, 8], help="comma separated threads per process")
+    parser.add_argument("--users", type=int_list, default=[1, 16], help="comma separated concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds per configuration")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring starts")
+    parser.add_argument("--latency", type=float, default=40, help="mean stub latency in ms")
+    parser.add_argument("--jitter", type=float, default=10, help="+/- ms around the mean stub latency")
+    parser.add_argument("--routes", default=",".join(ROUTES), help=f"comma separated, any of {', '.join(ROUTES)}")
+    parser.add_argument("--verbose", action="store_true", help="show the server's stderr")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    server = pick_server(args.server)
+
+    stub_port = free_port()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    # in its own process, so the stand-in for spotify does not compete with the load for this process's GIL
+    stub = subprocess.Popen([sys.executable, "stub_server.py", "--port", str(stub_port), "--latency", str(args.latency), "--jitter", str(args.jitter)],
+                            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(f"{stub_url}/__stats", stub)
+        from stub_server import fixtures
+        artist = fixtures["artists"][3]
+        all_paths = {
+            "home": "/home",
+            "artist": f"/home?artist_id={artist['id']}&artist_name={artist['name']}",
+            "wrapped": "/wrapped",
+        }
+        routes = args.routes.split(",")
+        paths = {route: all_paths[route] for route in routes}
+
+        results = []
+        for (workers, threads), users in itertools.product(server_configs(server, args.workers, args.threads), args.users):
+            print(f"{server} workers={workers} threads={threads or '-'} users={users}", file=sys.stderr)
+            results.append(run_config(server, workers, threads, users, paths, stub_url, args))
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    print_results(results, routes)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "server": server, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import gzip
+import hashlib
+import importlib.util
+import json
+import os
+import threading
+import zlib
+
+from response_cache import LruCache
+
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", 2000))
+FRAGMENT_CACHE_TTL = int(os.getenv("FRAGMENT_CACHE_TTL", 600))
+# below this a compressed body is barely smaller and costs more than it saves
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 512))
+COMPRESS_MIMETYPES = {"text/html", "text/plain", "text/css", "application/json", "application/javascript"}
+# pages are compressed on every request, so a fast level rather than the smallest output
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+HAS_BROTLI = importlib.util.find_spec("brotli") is not None
+
+
+def json_default(value):
+    # sets go in sorted, their own order differs between processes
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+
+def fingerprint(*parts):
+    # stable hash of whatever a page or fragment is rendered from, the same in every worker
+    data = json.dumps(parts, sort_keys=True, default=json_default, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+def files_version(*paths):
+    # changes whenever a template or the asset manifest does, so a deploy never answers 304 with an old page
+    entries = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in os.walk(path):
+                entries.extend(os.path.join(folder, name) for name in names)
+        elif os.path.exists(path):
+            entries.append(path)
+    return fingerprint([(entry, os.stat(entry).st_mtime_ns, os.stat(entry).st_size) for entry in sorted(entries)])
+
+
+class FragmentCache:
+    # rendered html keyed by the fingerprint of its data, identical data renders identical html for every user
+    def __init__(self, max_entries=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL):
+        self.fragments = LruCache(max_entries, ttl)
+        self.counters = {"hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+
+    def render(self, key, render):
+        html = self.fragments.get(key)
+        with self.lock:
+            self.counters["hits" if html is not None else "misses"] += 1
+        if html is None:
+            html = render()
+            self.fragments.set(key, html)
+        return html
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.fragments.entries), "max_entries": self.fragments.max_entries, **self.counters}
+
+
+def pick_encoding(accept_encodings):
+    if HAS_BROTLI and "br" in accept_encodings:
+        return "br"
+    if "gzip" in accept_encodings:
+        return "gzip"
+    return None
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        import brotli
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL)
+
+
+def compress_stream(chunks, encoding):
+    # every chunk is flushed on its own so a streamed page still reaches the browser panel by panel
+    if encoding == "br":
+        import brotli
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        # wbits 31 writes the gzip header and trailer
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress_response(response, accept_encodings):
+    if response.status_code != 200 or response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+    # files from send_file are passed through untouched, and precompressed assets already have an encoding
+    if response.direct_passthrough or "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = pick_encoding(accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
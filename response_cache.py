@@ -0,0 +1,206 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+
+# seconds each endpoint stays fresh before we revalidate it with spotify
+ENDPOINT_TTLS = {
+    "followed_artists": 300,
+    "following_contains": 300,
+    "saved_albums": 600,
+    "artist_search": 3600,
+    "artist_top_tracks": 3600,
+}
+DEFAULT_TTL = 60
+
+
+class CacheEntry:
+    def __init__(self, response, ttl):
+        self.response = response
+        self.etag = response.headers.get("ETag")
+        self.ttl = ttl
+        self.stored_at = time.time()
+
+    def is_fresh(self):
+        return time.time() - self.stored_at < self.ttl
+
+
+class ResponseCache:
+    # LRU of upstream responses keyed by (user, endpoint, url), stale entries stay around so their ETag can be revalidated
+    def __init__(self, max_entries=CACHE_SIZE, ttls=ENDPOINT_TTLS, default_ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count(self, endpoint, name):
+        counters = self.counters.setdefault(endpoint, {"hits": 0, "misses": 0, "revalidated": 0, "evictions": 0, "invalidations": 0})
+        counters[name] += 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, response):
+        endpoint = key[1]
+        with self.lock:
+            self.entries[key] = CacheEntry(response, self.ttls.get(endpoint, self.default_ttl))
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                evicted_key, _ = self.entries.popitem(last=False)
+                self.count(evicted_key[1], "evictions")
+
+    def touch(self, key):
+        # a 304 means our copy is still good, start its ttl over
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry.stored_at = time.time()
+
+    def invalidate(self, user, *endpoints):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == user and (not endpoints or key[1] in endpoints)]:
+                del self.entries[key]
+                self.count(key[1], "invalidations")
+
+    def record(self, endpoint, name):
+        with self.lock:
+            self.count(endpoint, name)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "endpoints": {endpoint: dict(counters) for endpoint, counters in self.counters.items()}
+            }
+
+
+class LruCache:
+    # plain value cache with one ttl, for data we assemble ourselves rather than whole responses
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] >= self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class KeyLocks:
+    # one lock per key so only one fetch per key runs at a time
+    # a key's lock is dropped once nobody holds or waits on it, so a waiter and a newcomer always share the same lock
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+
+class SharedDataset:
+    # one value for the whole process, refreshed in the background and served stale while a refresh runs
+    def __init__(self, name, loader, interval):
+        self.name = name
+        self.loader = loader
+        self.interval = interval
+        self.value = None
+        self.loaded_at = 0
+        self.refreshing = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.first_load_lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            value = self.loader()
+        except Exception as e:
+            print(f"Error refreshing {self.name}: {e}")
+            value = None
+
+        with self.lock:
+            # keep serving the last good value if the refresh failed
+            if value is not None:
+                self.value = value
+                self.loaded_at = time.time()
+            self.refreshing = False
+        return value
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.refresh, name=f"refresh-{self.name}", daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.refresh_in_background()
+
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name=f"refresher-{self.name}", daemon=True)
+            self.thread.start()
+
+    def get(self):
+        self.start()
+
+        if self.value is None:
+            # nothing to serve yet, the first callers wait for a single load
+            with self.first_load_lock:
+                if self.value is None:
+                    with self.lock:
+                        self.refreshing = True
+                    return self.refresh()
+            return self.value
+
+        if time.time() - self.loaded_at >= self.interval:
+            self.refresh_in_background()
+        return self.value
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,231 @@
+import base64
+import binascii
+import html
+import importlib.util
+import json
+import os
+import re
+import threading
+import time
+
+from instrumentation import record_parse
+
+# only checked for here, lxml and bs4 are imported the first time a page actually needs parsing
+HAS_LXML = importlib.util.find_spec("lxml") is not None
+
+# tried in this order until one of them finds something
+SCRAPE_BACKENDS = os.getenv("SCRAPE_BACKENDS", "embedded_state,lxml,strainer,html.parser").split(",")
+
+INITIAL_STATE_RE = re.compile(rb'<script id="initialState" type="text/plain">([^<]*)</script>')
+TAG_RE = re.compile(r"<[^>]+>")
+
+
+def as_bytes(html_content):
+    return html_content.encode("utf-8") if isinstance(html_content, str) else html_content
+
+
+def extract_initial_state(html_content):
+    # open.spotify.com ships the whole page state as base64 json, no html parsing needed to read it
+    match = INITIAL_STATE_RE.search(as_bytes(html_content))
+    if not match:
+        return None
+    try:
+        return json.loads(base64.b64decode(match.group(1)))
+    except (binascii.Error, ValueError):
+        return None
+
+
+def make_soup(html_content, parser, strainer=None):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html_content, parser, parse_only=strainer)
+
+
+def class_strainer(*class_names):
+    # matches any tag carrying one of the classes, even when it has several (a plain list only matches the whole attribute)
+    from bs4 import SoupStrainer
+    wanted = set(class_names)
+    return SoupStrainer(class_=lambda value: bool(value) and not wanted.isdisjoint(value.split()))
+
+
+def strip_tags(text):
+    return html.unescape(TAG_RE.sub("", text)).strip()
+
+
+class ArtistPage:
+    name = "artist"
+
+    def __init__(self, artist_id):
+        self.artist_id = artist_id
+
+    def empty(self):
+        return {"about": None, "monthly_listeners": None, "banner": None, "track_plays": []}
+
+    def is_empty(self, fields):
+        return not any(fields.values())
+
+    def from_state(self, state):
+        artist = state.get("entities", {}).get("items", {}).get(f"spotify:artist:{self.artist_id}")
+        if not artist:
+            return None
+
+        fields = self.empty()
+
+        biography = (artist.get("profile") or {}).get("biography") or {}
+        if biography.get("text"):
+            fields["about"] = strip_tags(biography["text"])
+
+        monthly_listeners = (artist.get("stats") or {}).get("monthlyListeners")
+        if monthly_listeners is not None:
+            fields["monthly_listeners"] = f"{monthly_listeners:,} monthly listeners"
+            fields["banner"] = f"{monthly_listeners:,}"
+
+        top_tracks = ((artist.get("discography") or {}).get("topTracks") or {}).get("items", [])
+        for item in top_tracks:
+            track = item.get("track") or {}
+            if track.get("name") and track.get("playcount"):
+                fields["track_plays"].append({
+                    "title": track["name"],
+                    "plays": f"{int(track['playcount']):,}"
+                })
+        return fields
+
+    def strainer(self):
+        return class_strainer("Zbad_ytC5aqG3ZISd4Gw", "fjP8GyQyM5IWQvTxWk6W", "Ydwa1P5GkCggtLlSvphs", "Hj3ST6Lg66UEtynHfOT8", "hxCObm")
+
+    def from_soup(self, soup):
+        fields = self.empty()
+
+        div_element = soup.find('div', class_='Zbad_ytC5aqG3ZISd4Gw')
+        span_element = div_element.find('span') if div_element else None
+        if span_element:
+            fields["about"] = span_element.get_text(strip=True)  # strip=True removes leading/trailing whitespace
+
+        monthly_listeners_div = soup.find('div', class_='fjP8GyQyM5IWQvTxWk6W')
+        if monthly_listeners_div:
+            fields["monthly_listeners"] = monthly_listeners_div.text
+
+        monthly_listeners_span = soup.find('span', class_='Ydwa1P5GkCggtLlSvphs')
+        if monthly_listeners_span and monthly_listeners_span.text.split():
+            fields["banner"] = monthly_listeners_span.text.split()[0]
+
+        spans = soup.find_all('span', class_='Hj3ST6Lg66UEtynHfOT8')
+        paragraphs = soup.find_all('p', class_='e-9640-text encore-text-body-small encore-internal-color-text-subdued ListRowDetails__ListRowDetailText-sc-sozu4l-0 hxCObm')
+        for span, paragraph in zip(spans, paragraphs):
+            fields["track_plays"].append({
+                "title": span.text.strip(),
+                "plays": paragraph.text.strip()
+            })
+        return fields
+
+
+class HomePage:
+    name = "home"
+
+    def empty(self):
+        return []
+
+    def is_empty(self, results):
+        return not results
+
+    def from_state(self, state):
+        # the homepage shelves are rendered client side, there is nothing for us in its initial state yet
+        return None
+
+    def strainer(self):
+        return class_strainer("ListRowTitle__LineClamp-sc-1xe2if1-0", "Image-sc-1u215sg-3")
+
+    def from_soup(self, soup):
+        span_elements = soup.find_all('span', class_='ListRowTitle__LineClamp-sc-1xe2if1-0')
+
+        results = []
+
+        for index, span in enumerate(span_elements):
+            if index >= 5:
+                break
+            img_element = span.find_previous('img', class_='Image-sc-1u215sg-3')
+
+            if img_element and 'src' in img_element.attrs:
+                results.append({
+                    'src': img_element['src'],
+                    'text': span.get_text(strip=True)
+                })
+        return results
+
+
+def embedded_state_backend(html_content, page):
+    state = extract_initial_state(html_content)
+    return page.from_state(state) if state else None
+
+
+def lxml_backend(html_content, page):
+    if not HAS_LXML:
+        return None
+    return page.from_soup(make_soup(html_content, 'lxml', page.strainer()))
+
+
+def strainer_backend(html_content, page):
+    # still html.parser, but only the tags we look at end up in the tree
+    return page.from_soup(make_soup(html_content, 'html.parser', page.strainer()))
+
+
+def soup_backend(html_content, page):
+    return page.from_soup(make_soup(html_content, 'html.parser'))
+
+
+class Scraper:
+    def __init__(self, backends=SCRAPE_BACKENDS):
+        self.registry = {
+            "embedded_state": embedded_state_backend,
+            "lxml": lxml_backend,
+            "strainer": strainer_backend,
+            "html.parser": soup_backend,
+        }
+        self.backends = [backend.strip() for backend in backends if backend.strip()]
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, backend, position=None):
+        self.registry[name] = backend
+        if name not in self.backends:
+            self.backends.insert(len(self.backends) if position is None else position, name)
+
+    def record(self, page, backend, duration):
+        with self.lock:
+            stats = self.stats.setdefault(page.name, {}).setdefault(backend, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"] += 1
+            stats["total_ms"] += duration * 1000
+            stats["max_ms"] = max(stats["max_ms"], duration * 1000)
+        record_parse(page.name, backend, duration)
+
+    def extract(self, html_content, page):
+        # returns (fields, backend used, seconds spent parsing)
+        started = time.perf_counter()
+
+        for backend in self.backends:
+            try:
+                result = self.registry[backend](html_content, page)
+            except Exception as e:
+                print(f"Scrape backend {backend} failed on {page.name} page: {e}")
+                continue
+
+            if result is not None and not page.is_empty(result):
+                duration = time.perf_counter() - started
+                self.record(page, backend, duration)
+                return result, backend, duration
+
+        duration = time.perf_counter() - started
+        self.record(page, "none", duration)
+        return page.empty(), None, duration
+
+    def report(self):
+        with self.lock:
+            return {
+                page: {
+                    backend: {**stats, "avg_ms": stats["total_ms"] / stats["count"]}
+                    for backend, stats in backends.items()
+                }
+                for page, backends in self.stats.items()
+            }
+
+
+scraper = Scraper()
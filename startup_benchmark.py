@@ -0,0 +1,107 @@
+"""Cold-start benchmark: how long a fresh worker takes to import the app and answer its first request.
+
+    python startup_benchmark.py --runs 10
+    python startup_benchmark.py --budget-ms 400 --json startup.json
+
+Every run is a new interpreter, so nothing is shared between runs. Reports import time,
+create_app time and time to the first response for `/`, plus the slowest modules from
+`python -X importtime`. With --budget-ms it exits non-zero when the median total is over budget.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# runs inside the fresh interpreter, prints one json line of timings in ms
+PROBE = """
+import json, time
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+app = index.create_app()
+created = time.perf_counter()
+response = app.test_client().get("/")
+answered = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_request_ms": (answered - created) * 1000,
+    "total_ms": (answered - started) * 1000,
+    "status": response.status_code,
+}))
+"""
+
+IMPORTTIME_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def probe_env(workdir):
+    env = dict(os.environ)
+    env.update({
+        "HISTORY_DB": os.path.join(workdir, "history.db"),
+        "ARTIST_PROFILE_DB": os.path.join(workdir, "artist_profiles.db"),
+        "TOKEN_STORE": env.get("TOKEN_STORE", "memory"),
+    })
+    env.setdefault("SECRET_KEY", "startup-benchmark")
+    return env
+
+
+def run_probe(env):
+    result = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"Probe failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, top):
+    # cumulative time of the modules index pulls in directly, from python's own import profiler
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import index"], cwd=ROOT, env=env, capture_output=True, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        # depth 1 are the imports written in index.py itself
+        if match and len(match.group(3)) == 3:
+            modules.append((match.group(4), int(match.group(2)) / 1000))
+    return sorted(modules, key=lambda module: module[1], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="how many of the slowest imports to list")
+    parser.add_argument("--budget-ms", type=float, help="fail when the median total startup is above this")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    env = probe_env(tempfile.mkdtemp(prefix="soundspace-startup-"))
+
+    # the first run also pays for writing bytecode, it is not what a deployed worker sees
+    run_probe(env)
+    runs = [run_probe(env) for _ in range(args.runs)]
+
+    summary = {key: round(statistics.median(run[key] for run in runs), 1) for key in ("import_ms", "create_app_ms", "first_request_ms", "total_ms")}
+    imports = slowest_imports(env, args.top)
+
+    print(f"{'median of ' + str(args.runs) + ' runs':<24} {'ms':>8}")
+    for key, value in summary.items():
+        print(f"{key:<24} {value:>8}")
+    print()
+    print(f"{'slowest imports':<40} {'ms':>8}")
+    for module, ms in imports:
+        print(f"{module:<40} {ms:>8.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": vars(args), "summary": summary, "runs": runs, "imports": imports}, f, indent=2)
+
+    if args.budget_ms is not None and summary["total_ms"] > args.budget_ms:
+        raise SystemExit(f"Startup took {summary['total_ms']} ms, over the {args.budget_ms} ms budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""Offline stand-in for the Spotify Web API, accounts service and open.spotify.com pages.
+
+Replays fixtures/spotify.json, fixtures/home.html and test.html (as the artist page) with
+configurable latency and error injection, and counts every call so benchmarks can report
+upstream traffic per route.
+
+    python stub_server.py --port 5055 --latency 80 --jitter 20 --error-rate 0.01
+
+then run the app with
+    SPOTIFY_API_BASE=http://127.0.0.1:5055 SPOTIFY_WEB_BASE=http://127.0.0.1:5055 SPOTIFY_ACCOUNTS_BASE=http://127.0.0.1:5055
+"""
+import argparse
+import base64
+import copy
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+
+from flask import Flask, request, redirect, Response
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(ROOT, "fixtures")
+ARTIST_PAGE = os.path.join(ROOT, "test.html")
+
+INITIAL_STATE_RE = re.compile(r'(<script id="initialState" type="text/plain">)([^<]*)(</script>)')
+
+app = Flask(__name__)
+
+config = {
+    "latency_ms": float(os.getenv("STUB_LATENCY_MS", 0)),
+    "jitter_ms": float(os.getenv("STUB_JITTER_MS", 0)),
+    "error_rate": float(os.getenv("STUB_ERROR_RATE", 0)),
+    "rate_limit_rate": float(os.getenv("STUB_RATE_LIMIT_RATE", 0)),
+    "retry_after": 1,
+}
+
+stats = {}
+stats_lock = threading.Lock()
+
+with open(os.path.join(FIXTURES, "spotify.json")) as f:
+    fixtures = json.load(f)
+
+artists_by_id = {artist["id"]: artist for artist in fixtures["artists"]}
+tracks_by_id = {track["id"]: track for track in fixtures["tracks"]}
+followed = list(fixtures["followed"])
+followed_lock = threading.Lock()
+
+# plays keep fixed timestamps from server start so `after` cursors behave like the real thing
+started_at_ms = int(time.time() * 1000)
+plays = []
+for i, track_id in enumerate(fixtures["recently_played"]):
+    played_at_ms = started_at_ms - i * 180000
+    played_at = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(played_at_ms / 1000)) + ".000Z"
+    plays.append((played_at_ms, {"track": tracks_by_id[track_id], "played_at": played_at, "context": None}))
+
+with open(os.path.join(FIXTURES, "home.html"), "rb") as f:
+    home_page = f.read()
+
+with open(ARTIST_PAGE, encoding="utf-8") as f:
+    artist_page = f.read()
+
+with open(os.path.join(ROOT, "static", "img", "keshi.jpg"), "rb") as f:
+    cover_image = f.read()
+
+
+def count(name):
+    with stats_lock:
+        stats[name] = stats.get(name, 0) + 1
+
+
+def json_response(data, status=200):
+    body = json.dumps(data).encode()
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers={"ETag": etag})
+    return Response(body, status=status, mimetype="application/json", headers={"ETag": etag})
+
+
+@app.before_request
+def inject_latency_and_errors():
+    if request.path.startswith("/__"):
+        return None
+
+    count(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}")
+
+    delay = config["latency_ms"] + random.uniform(-config["jitter_ms"], config["jitter_ms"])
+    if delay > 0:
+        time.sleep(delay / 1000)
+
+    roll = random.random()
+    if roll < config["rate_limit_rate"]:
+        count("injected 429")
+        return Response(json.dumps({"error": {"status": 429, "message": "API rate limit exceeded"}}), status=429,
+                        mimetype="application/json", headers={"Retry-After": str(config["retry_after"])})
+    if roll < config["rate_limit_rate"] + config["error_rate"]:
+        count("injected 503")
+        return Response(json.dumps({"error": {"status": 503, "message": "Service unavailable"}}), status=503, mimetype="application/json")
+
+    if request.path.startswith("/v1/") and not request.headers.get("Authorization", "").startswith("Bearer "):
+        return json_response({"error": {"status": 401, "message": "No token provided"}}, 401)
+    return None
+
+
+@app.route('/__stats')
+def get_stats():
+    with stats_lock:
+        return dict(stats)
+
+
+@app.route('/__reset', methods=['POST'])
+def reset_stats():
+    with stats_lock:
+        stats.clear()
+    return {"ok": True}
+
+
+@app.route('/__config', methods=['GET', 'POST'])
+def update_config():
+    if request.method == 'POST':
+        config.update({key: value for key, value in (request.get_json(silent=True) or {}).items() if key in config})
+    return config
+
+
+@app.route('/authorize')
+def authorize():
+    return redirect(f"{request.args['redirect_uri']}?code=stub-code")
+
+
+@app.route('/api/token', methods=['POST'])
+def token():
+    return json_response({
+        "access_token": "stub-access-" + os.urandom(8).hex(),
+        "token_type": "Bearer",
+        "expires_in": 3600,
+        "refresh_token": "stub-refresh",
+        "scope": "user-read-recently-played user-follow-read user-library-read user-follow-modify"
+    })
+
+
+@app.route('/v1/me')
+def me():
+    return json_response(fixtures["user"])
+
+
+@app.route('/v1/me/player/recently-played')
+def recently_played():
+    limit = request.args.get('limit', 20, type=int)
+    after = request.args.get('after', type=int)
+
+    items = [play for played_at_ms, play in plays if after is None or played_at_ms > after][:limit]
+
+    return json_response({
+        "items": items,
+        "limit": limit,
+        "next": None,
+        "cursors": {"after": str(started_at_ms), "before": str(started_at_ms - len(plays) * 180000)} if items else None
+    })
+
+
+@app.route('/v1/me/following', methods=['GET'])
+def following():
+    limit = request.args.get('limit', 20, type=int)
+    after = request.args.get('after')
+
+    with followed_lock:
+        ids = list(followed)
+    start = ids.index(after) + 1 if after in ids else 0
+    page = ids[start:start + limit]
+    has_next = start + limit < len(ids)
+
+    return json_response({"artists": {
+        "items": [artists_by_id[artist_id] for artist_id in page],
+        "limit": limit,
+        "total": len(ids),
+        "next": f"{request.host_url}v1/me/following?type=artist&after={page[-1]}&limit={limit}" if has_next and page else None,
+        "cursors": {"after": page[-1] if has_next and page else None}
+    }})
+
+
+@app.route('/v1/me/following', methods=['PUT', 'DELETE'])
+def change_following():
+    ids = [artist_id for artist_id in request.args.get('ids', '').split(',') if artist_id]
+    with followed_lock:
+        for artist_id in ids:
+            if request.method == 'PUT' and artist_id not in followed:
+                followed.insert(0, artist_id)
+            elif request.method == 'DELETE' and artist_id in followed:
+                followed.remove(artist_id)
+    return Response(status=204)
+
+
+@app.route('/v1/me/following/contains')
+def following_contains():
+    ids = request.args.get('ids', '').split(',')
+    with followed_lock:
+        return json_response([artist_id in followed for artist_id in ids])
+
+
+@app.route('/v1/me/albums')
+def saved_albums():
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', 20, type=int)
+    albums = fixtures["albums"]
+    page = albums[offset:offset + limit]
+
+    return json_response({
+        "items": [{"added_at": "2025-01-01T00:00:00Z", "album": album} for album in page],
+        "limit": limit,
+        "offset": offset,
+        "total": len(albums),
+        "next": f"{request.host_url}v1/me/albums?offset={offset + limit}&limit={limit}" if offset + limit < len(albums) else None
+    })
+
+
+@app.route('/v1/search')
+def search():
+    query = request.args.get('q', '').lower()
+    limit = request.args.get('limit', 20, type=int)
+    matches = [artist for artist in fixtures["artists"] if query and query in artist["name"].lower()]
+    return json_response({"artists": {"items": matches[:limit], "limit": limit, "offset": 0, "total": len(matches)}})
+
+
+@app.route('/v1/artists')
+def several_artists():
+    ids = request.args.get('ids', '').split(',')
+    if len(ids) > 50:
+        return json_response({"error": {"status": 400, "message": "Too many ids requested"}}, 400)
+    return json_response({"artists": [artists_by_id.get(artist_id) for artist_id in ids]})
+
+
+@app.route('/v1/artists/<artist_id>/top-tracks')
+def top_tracks(artist_id):
+    tracks = [track for track in fixtures["tracks"] if any(artist["id"] == artist_id for artist in track["artists"])]
+    return json_response({"tracks": (tracks or fixtures["tracks"])[:10]})
+
+
+@lru_cache(maxsize=256)
+def render_artist_page(artist_id):
+    # test.html is a real artist page, re-key its embedded state so any artist id gets a matching page
+    match = INITIAL_STATE_RE.search(artist_page)
+    state = json.loads(base64.b64decode(match.group(2)))
+
+    entities = state["entities"]["items"]
+    original_key = next(key for key in entities if key.startswith("spotify:artist:"))
+    entity = copy.deepcopy(entities.pop(original_key))
+    entity["uri"] = f"spotify:artist:{artist_id}"
+    if artist_id in artists_by_id:
+        entity["profile"]["name"] = artists_by_id[artist_id]["name"]
+    entities[f"spotify:artist:{artist_id}"] = entity
+
+    encoded = base64.b64encode(json.dumps(state).encode()).decode()
+    return artist_page[:match.start(2)] + encoded + artist_page[match.end(2):]
+
+
+@app.route('/artist/<artist_id>')
+def artist(artist_id):
+    return Response(render_artist_page(artist_id), mimetype="text/html")
+
+
+@app.route('/image/<image_id>')
+def image(image_id):
+    # stands in for i.scdn.co, every id gets the same picture
+    return Response(cover_image, mimetype="image/jpeg")
+
+
+@app.route('/')
+def home():
+    return Response(home_page, mimetype="text/html")
+
+
+def start_in_thread(host="127.0.0.1", port=0, **overrides):
+    # used by benchmarks, returns the running server and its base url
+    config.update(overrides)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency", type=float, default=config["latency_ms"], help="mean added latency in ms")
+    parser.add_argument("--jitter", type=float, default=config["jitter_ms"], help="+/- ms around the mean latency")
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"], help="fraction of calls answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=config["rate_limit_rate"], help="fraction of calls answered with 429")
+    args = parser.parse_args()
+
+    config.update(latency_ms=args.latency, jitter_ms=args.jitter, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
+    print(f"Spotify stub listening on http://{args.host}:{args.port}")
+    make_server(args.host, args.port, app, threaded=True).serve_forever()
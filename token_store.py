@@ -0,0 +1,131 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# tokens outlive a single access token because of the refresh token, a month is plenty for a login
+SESSION_TTL = int(os.getenv("SESSION_TTL", 30 * 24 * 3600))
+
+
+class MemoryTokenStore:
+    # only shared inside one process, fine for `flask run` and tests
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            entry = self.records.get(session_id)
+            if not entry:
+                return None
+            if entry["expires_at"] < time.time():
+                del self.records[session_id]
+                return None
+            return dict(entry["record"])
+
+    def set(self, session_id, record):
+        with self.lock:
+            self.records[session_id] = {"record": dict(record), "expires_at": time.time() + self.ttl}
+
+    def delete(self, session_id):
+        with self.lock:
+            self.records.pop(session_id, None)
+
+
+class SqliteTokenStore:
+    # a local file every worker on the same machine can see
+    def __init__(self, path, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS tokens (session_id TEXT PRIMARY KEY, record TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, session_id):
+        with self.connect() as conn:
+            row = conn.execute("SELECT record, expires_at FROM tokens WHERE session_id = ?", (session_id,)).fetchone()
+        if not row:
+            return None
+        if row[1] < time.time():
+            self.delete(session_id)
+            return None
+        return json.loads(row[0])
+
+    def set(self, session_id, record):
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO tokens (session_id, record, expires_at) VALUES (?, ?, ?)",
+                (session_id, json.dumps(record), time.time() + self.ttl)
+            )
+
+    def delete(self, session_id):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM tokens WHERE session_id = ?", (session_id,))
+
+
+class LocalRedis:
+    # just enough of the redis-py client for RedisTokenStore, used when no redis server is around
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires_at = self.values.get(key, (None, None))
+            if expires_at is not None and expires_at < time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.values[key] = (value.encode() if isinstance(value, str) else value, time.time() + ex if ex else None)
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            return 1 if self.values.pop(key, None) else 0
+
+
+class RedisTokenStore:
+    # shared by every worker and instance pointing at the same redis
+    def __init__(self, client, ttl=SESSION_TTL, prefix="soundspace:token:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, session_id):
+        value = self.client.get(self.prefix + session_id)
+        return json.loads(value) if value else None
+
+    def set(self, session_id, record):
+        self.client.set(self.prefix + session_id, json.dumps(record), ex=self.ttl)
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+
+
+def make_token_store(url):
+    # TOKEN_STORE is "memory", "sqlite:///path/to/file.db", "redis://host:port/db" or "redis-local"
+    if not url or url == "memory":
+        return MemoryTokenStore()
+
+    if url.startswith("sqlite:///"):
+        return SqliteTokenStore(url[len("sqlite:///"):])
+
+    if url == "redis-local":
+        return RedisTokenStore(LocalRedis())
+
+    if url.startswith(("redis://", "rediss://")):
+        try:
+            import redis
+        except ImportError:
+            print("redis package is not installed, falling back to the local redis stand-in")
+            return RedisTokenStore(LocalRedis())
+        return RedisTokenStore(redis.Redis.from_url(url))
+
+    raise ValueError(f"Unknown TOKEN_STORE: {url}")